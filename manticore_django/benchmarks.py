@@ -0,0 +1,280 @@
+"""
+Offline benchmarks for the Media image pipeline.
+
+Synthetic originals are run through render_and_upload_to, process_thumbnail and resize_model_photos against an
+in-memory storage, each case in a fresh process so its peak memory can be measured on its own. Results can be
+saved as a baseline and later runs compared against it.
+"""
+import json
+import os
+import resource
+import time
+import traceback
+from multiprocessing import Process, Queue
+from Queue import Empty
+from StringIO import StringIO
+
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+
+# (format, mode) pairs the synthetic originals are generated in
+FORMAT_MODES = (
+    ('JPEG', 'RGB'),
+    ('JPEG', 'L'),
+    ('PNG', 'RGB'),
+    ('PNG', 'RGBA'),
+    ('GIF', 'P'),
+)
+
+RESOLUTIONS = (
+    (640, 480),
+    (1920, 1080),
+    (4000, 3000),
+    (6000, 4000),
+)
+
+DEFAULT_SIZES = {
+    'thumbnail': {'width': 200, 'height': 200},
+    'large_photo': {'width': 1024, 'height': 768},
+}
+
+METRICS = ('wall', 'cpu', 'peak_rss_kb')
+
+
+class InMemoryStorage(Storage):
+    """
+    Storage keeping saved files in a dict, so benchmarks never touch the network
+    """
+    def __init__(self):
+        self.files = {}
+
+    def _open(self, name, mode='rb'):
+        return ContentFile(self.files[name])
+
+    def _save(self, name, content):
+        content.seek(0)
+        self.files[name] = content.read()
+        return name
+
+    def exists(self, name):
+        return name in self.files
+
+    def delete(self, name):
+        self.files.pop(name, None)
+
+    def size(self, name):
+        return len(self.files[name])
+
+    def url(self, name):
+        return "memory://%s" % name
+
+
+def make_original(image_format, mode, size):
+    """
+    Encoded bytes of a noisy gradient image, which compresses roughly like a photo
+    """
+    noise = Image.effect_noise(size, 48)
+    gradient = Image.linear_gradient('L').resize(size) if hasattr(Image, 'linear_gradient') else noise
+    if mode == 'L':
+        im = Image.blend(noise, gradient, 0.5)
+    else:
+        im = Image.merge('RGB', (noise, gradient, Image.blend(noise, gradient, 0.5)))
+        if mode == 'RGBA':
+            im.putalpha(gradient)
+        elif mode == 'P':
+            im = im.convert('P', palette=Image.ADAPTIVE)
+
+    buf = StringIO()
+    im.save(buf, image_format)
+    return buf.getvalue()
+
+
+class BenchmarkError(Exception):
+    """
+    Raised when a benchmark case fails, crashes or runs past its timeout
+    """
+    pass
+
+
+def benchmark_instance(model_label, sizes, storage):
+    """
+    Unsaved Media instance whose SIZES are ``sizes`` and whose files are saved to ``storage``.
+
+    ``model_label`` names the concrete model as ``app_label.ModelName``. Without one a model built on the abstract
+    Media is used, which only has fields for the default sizes. Saves are skipped, so no database is needed.
+    Only call this in a benchmark process, as it replaces the storage of the model's file fields.
+    """
+    from django.db.models import FileField
+    from manticore_django.manticore_django.models import Media
+    from manticore_django.manticore_django.utils import get_model
+
+    if model_label:
+        model = get_model(*model_label.split("."))
+    else:
+        class BenchmarkMedia(Media):
+            class Meta:
+                app_label = "manticore_django_benchmarks"
+        model = BenchmarkMedia
+
+    for field in model._meta.fields:
+        if isinstance(field, FileField):
+            field.storage = storage
+    instance = model()
+    instance.SIZES = sizes
+    instance.defer_thumbnails = False
+    instance.save = lambda *args, **kwargs: None
+    return instance
+
+
+def _prepare_render_and_upload_to(data, sizes, model_label, storage):
+    from manticore_django.manticore_django.models import render_and_upload_to
+
+    def destination(size_name, name):
+        return storage, "%s/%s" % (size_name, name)
+
+    return lambda: render_and_upload_to(destination, Image.open(StringIO(data)), "benchmark", sizes, False)
+
+
+def _assign_original(data, sizes, model_label, storage):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    image_format = Image.open(StringIO(data)).format
+    instance = benchmark_instance(model_label, sizes, storage)
+    name = "benchmark.%s" % {'JPEG': 'jpg'}.get(image_format, image_format.lower())
+    setattr(instance, getattr(instance, "original_file_name", "original_file"), SimpleUploadedFile(name, data))
+    return instance
+
+
+def _prepare_process_thumbnail(data, sizes, model_label, storage):
+    from manticore_django.manticore_django.models import process_thumbnail
+
+    instance = _assign_original(data, sizes, model_label, storage)
+    original_file = getattr(instance, getattr(instance, "original_file_name", "original_file"))
+    return lambda: process_thumbnail(instance, original_file, sizes, save=False)
+
+
+def _prepare_resize_model_photos(data, sizes, model_label, storage):
+    from manticore_django.manticore_django.models import resize_model_photos
+
+    instance = _assign_original(data, sizes, model_label, storage)
+    return lambda: resize_model_photos(instance, True, False)
+
+
+# Pipeline functions each case is run through. Each entry prepares its inputs and returns the call to time
+ENTRY_POINTS = (
+    ('render_and_upload_to', _prepare_render_and_upload_to),
+    ('process_thumbnail', _prepare_process_thumbnail),
+    ('resize_model_photos', _prepare_resize_model_photos),
+)
+
+
+def _run_case(data, sizes, entry_point, model_label, queue):
+    try:
+        run = dict(ENTRY_POINTS)[entry_point](data, sizes, model_label, InMemoryStorage())
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        times_before = os.times()
+        wall_before = time.time()
+
+        run()
+
+        wall = time.time() - wall_before
+        times_after = os.times()
+        queue.put({
+            'wall': wall,
+            'cpu': (times_after[0] - times_before[0]) + (times_after[1] - times_before[1]),
+            'peak_rss_kb': max(0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before),
+        })
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+
+def _wait_for_result(process, queue, timeout):
+    """
+    The result ``process`` puts on ``queue``, failing as soon as it exits without one or runs past ``timeout``
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            if process.exitcode is not None:
+                raise BenchmarkError("Benchmark process exited with code %s" % process.exitcode)
+            if time.time() > deadline:
+                process.terminate()
+                raise BenchmarkError("Benchmark process timed out after %d seconds" % timeout)
+            continue
+        if 'error' in result:
+            raise BenchmarkError(result['error'])
+        return result
+
+
+def measure(data, sizes, repeat=3, entry_point='render_and_upload_to', model_label=None, timeout=600):
+    """
+    Best wall and CPU time and lowest peak memory growth of ``repeat`` runs of ``entry_point``, each in its own
+    process. Raises BenchmarkError if a run fails or takes longer than ``timeout`` seconds
+    """
+    best = {}
+    for i in range(repeat):
+        queue = Queue()
+        process = Process(target=_run_case, args=(data, sizes, entry_point, model_label, queue))
+        process.start()
+        try:
+            result = _wait_for_result(process, queue, timeout)
+        finally:
+            process.join()
+        for metric in METRICS:
+            best[metric] = min(best.get(metric, result[metric]), result[metric])
+    return best
+
+
+def run_benchmarks(sizes=None, resolutions=RESOLUTIONS, format_modes=FORMAT_MODES, repeat=3, log=None,
+                   model_label=None, entry_points=None, timeout=600):
+    """
+    Runs every (format, mode, resolution) original through each of ``entry_points`` (default: all of
+    ENTRY_POINTS) for each size spec on its own and for all sizes together. Returns results keyed
+    ``"FORMAT-mode-WxH:size_name:entry_point"``.
+    """
+    sizes = sizes or DEFAULT_SIZES
+    entry_points = entry_points or [name for name, prepare in ENTRY_POINTS]
+    results = {}
+    for image_format, mode in format_modes:
+        for resolution in resolutions:
+            data = make_original(image_format, mode, resolution)
+            case = "%s-%s-%dx%d" % (image_format, mode, resolution[0], resolution[1])
+            specs = [(size_name, {size_name: size}) for size_name, size in sorted(sizes.items())]
+            specs.append(('all', sizes))
+            for size_name, case_sizes in specs:
+                for entry_point in entry_points:
+                    key = "%s:%s:%s" % (case, size_name, entry_point)
+                    results[key] = measure(data, case_sizes, repeat, entry_point, model_label, timeout)
+                    if log:
+                        log(key, results[key])
+    return results
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Cases where a metric is more than ``tolerance`` worse than the baseline, as
+    ``(key, metric, baseline value, current value)``
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        for metric in METRICS:
+            previous = baseline[key].get(metric)
+            if previous and result[metric] > previous * (1 + tolerance):
+                regressions.append((key, metric, previous, result[metric]))
+    return regressions
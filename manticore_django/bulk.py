@@ -0,0 +1,164 @@
+import os
+import time
+import traceback
+from itertools import islice
+from multiprocessing import Pool
+
+from django.core.files.base import File
+from django.db import connection
+
+from manticore_django.manticore_django.media_settings import MEDIA_PIPELINE
+from manticore_django.manticore_django.models import Media, regenerate_media, run_on_commit, save_image
+from manticore_django.manticore_django.utils import get_model, get_thread_pool, retry_cloudfiles
+
+
+def init_worker():
+    # Forked workers must not share the parent's database connection
+    connection.close()
+
+
+def regenerate_worker(args):
+    """
+    Pool worker regenerating one ``(app_label, model_name, pk)``, returning ``(pk, traceback or None)``
+    """
+    app_label, model_name, pk = args
+    try:
+        regenerate_media(get_model(app_label, model_name), pk)
+        return pk, None
+    except Exception:
+        return pk, traceback.format_exc()
+
+
+def _as_file(source):
+    """
+    Wraps a path, ``(name, file object)`` pair or File as a File
+    """
+    if isinstance(source, basestring):
+        return File(open(source, "rb"), name=os.path.basename(source))
+    if isinstance(source, tuple):
+        name, file_object = source
+        return File(file_object, name=name)
+    return source
+
+
+def _source_name(source):
+    if isinstance(source, basestring):
+        return os.path.basename(source)
+    if isinstance(source, tuple):
+        return source[0]
+    return source.name
+
+
+def _upload_source(storage, name, source):
+    """
+    Uploads one source, keeping it open only while it is uploaded so a batch never holds more open files than
+    there are upload threads
+    """
+    content = _as_file(source)
+    try:
+        return retry_cloudfiles(save_image, storage, name, content)
+    finally:
+        content.close()
+
+
+def bulk_ingest_media(model, sources, batch_size=500, defaults=None, defer=None, processes=4):
+    """
+    Creates one `model` row per file source with bulk_create, then schedules derivative generation for each batch.
+
+    `sources` yields paths, ``(name, file object)`` pairs or Files. Originals of a batch are uploaded from a thread
+    pool, the rows inserted in one query, and derivatives either queued as Celery tasks (`defer`, defaulting to
+    MEDIA_PIPELINE["DEFER_THUMBNAILS"]) or rendered in a pool of `processes` worker processes.
+
+    Yields a progress dict after every batch. Its ``errors`` are the ``(file name, message)`` pairs of the files
+    in that batch that failed to upload, insert or render.
+    """
+    if defer is None:
+        defer = MEDIA_PIPELINE["DEFER_THUMBNAILS"]
+    original_file_name = getattr(model, "original_file_name", "original_file")
+    field = model._meta.get_field(original_file_name)
+
+    progress = {"batches": 0, "created": 0, "scheduled": 0, "failed": 0, "errors": []}
+    started = time.time()
+
+    if not defer:
+        connection.close()
+        pool = Pool(processes, initializer=init_worker)
+    sources = iter(sources)
+    try:
+        while True:
+            batch = list(islice(sources, batch_size))
+            if not batch:
+                break
+
+            instances, errors = _upload_batch(model, field, batch, defaults or {})
+            stored_names = [getattr(instance, original_file_name).name for instance in instances]
+            try:
+                model._default_manager.bulk_create(instances)
+            except Exception:
+                # Don't leave objects behind that no row points at
+                error = traceback.format_exc()
+                for stored_name in stored_names:
+                    field.storage.delete(stored_name)
+                errors.extend((stored_name, error) for stored_name in stored_names)
+                instances, stored_names = [], []
+            # bulk_create doesn't return primary keys on every backend, so look them up by original name
+            names_by_pk = dict(model._default_manager.filter(**{"%s__in" % original_file_name: stored_names})
+                               .values_list("pk", original_file_name))
+
+            if defer:
+                from manticore_django.manticore_django.tasks import generate_media_derivatives
+
+                def send(pks=list(names_by_pk)):
+                    for pk in pks:
+                        generate_media_derivatives.delay(model._meta.app_label, model._meta.object_name, pk)
+
+                # A worker picking the task up before the rows commit would find nothing to process
+                run_on_commit(send)
+            else:
+                args = [(model._meta.app_label, model._meta.object_name, pk) for pk in names_by_pk]
+                for pk, error in pool.imap_unordered(regenerate_worker, args):
+                    if error:
+                        errors.append((names_by_pk[pk], error))
+
+            elapsed = time.time() - started
+            progress["batches"] += 1
+            progress["created"] += len(instances)
+            progress["scheduled"] += len(names_by_pk)
+            progress["failed"] += len(errors)
+            progress["errors"] = errors
+            progress["rate"] = progress["created"] / elapsed if elapsed else 0
+            yield dict(progress)
+    finally:
+        if not defer:
+            pool.close()
+            pool.join()
+
+
+def _upload_batch(model, field, batch, defaults):
+    """
+    Uploads the originals of one batch in parallel and returns unsaved instances pointing at them, plus
+    ``(name, error)`` for each file that couldn't be uploaded
+    """
+    pool = get_thread_pool("uploads", MEDIA_PIPELINE["UPLOAD_THREADS"])
+    uploads = []
+    for source in batch:
+        instance = model(**defaults)
+        instance.media_type = Media.TYPE_CHOICES.image
+        instance.processing_state = Media.PROCESSING_CHOICES.pending
+        name = _source_name(source)
+        result = pool.apply_async(_upload_source, (field.storage, field.generate_filename(instance, name), source))
+        uploads.append((instance, name, result))
+
+    uploaded, errors = [], []
+    for instance, name, result in uploads:
+        try:
+            stored_name = result.get()
+        except Exception:
+            errors.append((name, traceback.format_exc()))
+            continue
+        if stored_name:
+            setattr(instance, field.name, stored_name)
+            uploaded.append(instance)
+        else:
+            errors.append((name, "upload failed"))
+    return uploaded, errors
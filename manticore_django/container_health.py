@@ -0,0 +1,192 @@
+"""
+Tracks how uploads to each container and region are doing, and picks the containers new files are written to.
+
+Latency (seconds per megabyte, counting small files as one megabyte) and error rate are kept as exponentially
+weighted averages per process. A container, or a whole region, whose error rate passes
+CUMULUS["CONTAINER_ERROR_THRESHOLD"] is left out of selection for CUMULUS["CONTAINER_EJECT_SECONDS"].
+"""
+import random
+import threading
+import time
+
+from django.core.signals import request_started
+
+from .cumulus_settings import CUMULUS
+from .utils import get_class
+
+
+class _Average(object):
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.ejected_until = 0
+
+    def add(self, latency, error, decay):
+        if not error:
+            self.latency = latency if self.latency is None else decay * latency + (1 - decay) * self.latency
+        self.error_rate = decay * (1.0 if error else 0.0) + (1 - decay) * self.error_rate
+        self.samples += 1
+
+
+class ContainerHealth(object):
+    """
+    Recent upload latency and error rate per container and per region.
+    """
+    def __init__(self, decay, error_threshold, min_samples, eject_seconds):
+        self.decay = decay
+        self.error_threshold = error_threshold
+        self.min_samples = min_samples
+        self.eject_seconds = eject_seconds
+        self.containers = {}
+        self.regions = {}
+        self._lock = threading.Lock()
+
+    def record(self, container_name, region, elapsed, size=None, error=False):
+        """
+        Records one upload of ``size`` bytes that took ``elapsed`` seconds, or failed.
+        """
+        latency = elapsed / max(1.0, (size or 0) / (1024.0 * 1024))
+        now = time.time()
+        with self._lock:
+            for averages, key in ((self.containers, container_name), (self.regions, region)):
+                average = averages.setdefault(key, _Average())
+                if average.ejected_until > now:
+                    # Uploads that were already running when it was ejected
+                    continue
+                average.add(latency, error, self.decay)
+                if error and average.samples >= self.min_samples and average.error_rate > self.error_threshold:
+                    average.ejected_until = now + self.eject_seconds
+                    # Give it a fresh start once it's back, so one more failure doesn't eject it straight away
+                    average.error_rate = self.error_threshold / 2
+
+    def available(self, container_name, region, now=None):
+        now = now or time.time()
+        with self._lock:
+            for averages, key in ((self.containers, container_name), (self.regions, region)):
+                average = averages.get(key)
+                if average is not None and average.ejected_until > now:
+                    return False
+        return True
+
+    def latency(self, container_name):
+        average = self.containers.get(container_name)
+        return average.latency if average is not None else None
+
+    def error_rate(self, container_name):
+        average = self.containers.get(container_name)
+        return average.error_rate if average is not None else 0.0
+
+    def stats(self):
+        """
+        ``{"containers": {name: {...}}, "regions": {name: {...}}}`` with each one's latency, error rate,
+        sample count and whether it is currently ejected.
+        """
+        now = time.time()
+        with self._lock:
+            return dict((kind, dict((key, {"latency": average.latency, "error_rate": average.error_rate,
+                                           "samples": average.samples, "ejected": average.ejected_until > now})
+                                    for key, average in averages.items()))
+                        for kind, averages in (("containers", self.containers), ("regions", self.regions)))
+
+
+class ContainerSelector(object):
+    """
+    Picks a container for a new file from the candidates whose container and region are not ejected, or from
+    all of them if every one is.
+    """
+    def __init__(self, health, get_region):
+        self.health = health
+        self.get_region = get_region
+
+    def healthy(self, containers):
+        now = time.time()
+        healthy = [name for name in containers if self.health.available(name, self.get_region(name), now)]
+        return healthy or list(containers)
+
+    def choose(self, containers):
+        raise NotImplementedError
+
+
+class WeightedRandomSelector(ContainerSelector):
+    """
+    Random choice weighted by ``(1 - error rate) / latency``. Containers without samples get the average weight
+    of the others, so they are tried and measured.
+    """
+    def choose(self, containers):
+        candidates = self.healthy(containers)
+        latencies = [self.health.latency(name) for name in candidates]
+        known = [latency for latency in latencies if latency]
+        default = sum(known) / len(known) if known else 1.0
+        weights = [max(0.01, 1 - self.health.error_rate(name)) / (latency or default)
+                   for name, latency in zip(candidates, latencies)]
+        point = random.uniform(0, sum(weights))
+        for name, weight in zip(candidates, weights):
+            point -= weight
+            if point <= 0:
+                return name
+        return candidates[-1]
+
+
+class LeastLatencySelector(ContainerSelector):
+    """
+    The healthy container with the lowest latency. CUMULUS["CONTAINER_EXPLORE_RATIO"] of the picks are random
+    instead, so the others keep being measured.
+    """
+    def choose(self, containers):
+        candidates = self.healthy(containers)
+        unmeasured = [name for name in candidates if self.health.latency(name) is None]
+        if unmeasured:
+            return random.choice(unmeasured)
+        if random.random() < CUMULUS["CONTAINER_EXPLORE_RATIO"]:
+            return random.choice(candidates)
+        return min(candidates, key=self.health.latency)
+
+
+class StickySelector(WeightedRandomSelector):
+    """
+    Weighted random choice made once per request (or per thread outside requests), and kept for every file
+    that request saves until its container is ejected.
+    """
+    def __init__(self, health, get_region):
+        super(StickySelector, self).__init__(health, get_region)
+        self._local = threading.local()
+        request_started.connect(self.reset, weak=False)
+
+    def reset(self, **kwargs):
+        self._local.choices = {}
+
+    def choose(self, containers):
+        choices = getattr(self._local, "choices", None)
+        if choices is None:
+            choices = self._local.choices = {}
+        key = tuple(containers)
+        name = choices.get(key)
+        if name is None or not self.health.available(name, self.get_region(name)):
+            name = choices[key] = super(StickySelector, self).choose(containers)
+        return name
+
+
+SELECTORS = {
+    "weighted_random": WeightedRandomSelector,
+    "least_latency": LeastLatencySelector,
+    "sticky": StickySelector,
+}
+
+container_health = ContainerHealth(CUMULUS["CONTAINER_HEALTH_DECAY"], CUMULUS["CONTAINER_ERROR_THRESHOLD"],
+                                   CUMULUS["CONTAINER_MIN_SAMPLES"], CUMULUS["CONTAINER_EJECT_SECONDS"])
+
+_selector = None
+
+
+def get_container_selector():
+    """
+    The ContainerSelector named by CUMULUS["CONTAINER_SELECTION"]: "weighted_random", "least_latency", "sticky"
+    or the dotted path of a ContainerSelector subclass.
+    """
+    global _selector
+    if _selector is None:
+        policy = CUMULUS["CONTAINER_SELECTION"]
+        selector_class = SELECTORS[policy] if policy in SELECTORS else get_class(policy)
+        _selector = selector_class(container_health, lambda name: CUMULUS.get("CONTAINER_REGIONS", {}).get(name))
+    return _selector
@@ -13,6 +13,10 @@ CUMULUS = {
     "CONTAINER": None,
     "CONTAINER_URI": None,
     "CONTAINER_SSL_URI": None,
+    # Per-container (cdn_uri, cdn_ssl_uri) used instead of asking the API; URIs that are asked for are
+    # cached per process and refreshed in the background every CONTAINER_URL_REFRESH seconds
+    "CONTAINER_CDN_URIS": {},
+    "CONTAINER_URL_REFRESH": 60 * 60,
     "SERVICENET": False,
     "TIMEOUT": 5,
     "TTL": CFClient.default_cdn_ttl,  # 86400s (24h), pyrax default
@@ -22,9 +26,59 @@ CUMULUS = {
     "INCLUDE_LIST": [],
     "EXCLUDE_LIST": [],
     "HEADERS": {},
+    # Bytes read ahead per request when reading a stored file
+    "READ_AHEAD_SIZE": 1024 * 1024,
+    # Directory of a local read-through cache of stored files shared by all processes. None disables it.
+    # Files over DISK_CACHE_MAX_OBJECT_BYTES (None is a tenth of the budget) are always read remotely
+    "DISK_CACHE_DIR": None,
+    "DISK_CACHE_MAX_BYTES": 1024 * 1024 * 1024,
+    "DISK_CACHE_MAX_OBJECT_BYTES": None,
+    # Content types gzipped on upload, as a list (level 6) or a dict of content type to compression level
     "GZIP_CONTENT_TYPES": [],
+    # Files are only gzipped when a GZIP_SAMPLE_SIZE sample compresses to at most GZIP_MAX_RATIO of its size
+    "GZIP_MIN_SIZE": 1024,
+    "GZIP_SAMPLE_SIZE": 64 * 1024,
+    "GZIP_MAX_RATIO": 0.9,
     "USE_PYRAX": True,
     "PYRAX_IDENTITY_TYPE": None,
+    # Seconds object metadata from HEAD requests is cached per process, for existing and missing objects
+    "OBJECT_CACHE_TTL": 60,
+    "OBJECT_CACHE_NEGATIVE_TTL": 10,
+    "OBJECT_CACHE_MAX_ENTRIES": 10000,
+    # Entries fetched per request when listing a container
+    "LISTING_PAGE_SIZE": 10000,
+    # Dotted path of the store sharing auth tokens between processes. None authenticates every process.
+    # token_cache provides CacheTokenStore (Django cache "AUTH_TOKEN_CACHE") and FileTokenStore ("AUTH_TOKEN_DIR")
+    "AUTH_TOKEN_STORE": None,
+    "AUTH_TOKEN_CACHE": "default",
+    # None uses a cumulus-auth-<uid> directory in the system temporary directory
+    "AUTH_TOKEN_DIR": None,
+    # Token lifetime assumed when the identity API doesn't report one, and how early tokens are refreshed
+    "AUTH_TOKEN_TTL": 12 * 60 * 60,
+    "AUTH_TOKEN_MARGIN": 5 * 60,
+    # Seconds a process waits for another one to finish refreshing a token
+    "AUTH_TOKEN_LOCK_TIMEOUT": 30,
+    # Files bigger than this are uploaded as segmented large objects. None disables segmenting
+    "LARGE_OBJECT_THRESHOLD": 1024 * 1024 * 1024,
+    "SEGMENT_SIZE": 100 * 1024 * 1024,
+    "SEGMENT_THREADS": 4,
+    "SEGMENT_RETRIES": 3,
+    # Bytes of segments read into memory ahead of their upload. One segment is always allowed
+    "SEGMENT_BUFFER_BYTES": 200 * 1024 * 1024,
+    "SEGMENT_CONTAINER_SUFFIX": "_segments",
+    # "static" or "dynamic"
+    "LARGE_OBJECT_MANIFEST": "static",
+    # How MultiContainerCloudFilesStorage picks the container of a new file: "weighted_random", "least_latency",
+    # "sticky" (one weighted random pick per request) or the dotted path of a container_health.ContainerSelector
+    "CONTAINER_SELECTION": "weighted_random",
+    # Weight of the newest upload in each container's and region's latency and error rate averages
+    "CONTAINER_HEALTH_DECAY": 0.2,
+    # Containers or regions whose error rate passes the threshold are skipped for CONTAINER_EJECT_SECONDS
+    "CONTAINER_ERROR_THRESHOLD": 0.5,
+    "CONTAINER_MIN_SAMPLES": 5,
+    "CONTAINER_EJECT_SECONDS": 30,
+    # Share of least_latency picks made at random, so slower containers keep being measured
+    "CONTAINER_EXPLORE_RATIO": 0.05,
 }
 
 if hasattr(settings, "CUMULUS"):
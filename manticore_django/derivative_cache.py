@@ -0,0 +1,142 @@
+import hashlib
+import json
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError
+
+from manticore_django.manticore_django.imaging import get_encoder_profile
+from manticore_django.manticore_django.media_settings import MEDIA_PIPELINE
+from manticore_django.manticore_django.utils import get_cache, get_class, get_model
+
+
+def content_digest(file, algorithm="sha1", chunk_size=64 * 1024):
+    """
+    Hex digest of everything readable from ``file``, leaving the file rewound
+    """
+    digest = hashlib.new(algorithm)
+    file.seek(0)
+    chunk = file.read(chunk_size)
+    while chunk:
+        digest.update(chunk)
+        chunk = file.read(chunk_size)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def derivative_key(digest, size, crop=False, image_format=None):
+    """
+    Normalized index key for one size spec of one original, optionally for one of its alternate formats
+    """
+    profile = json.dumps(get_encoder_profile(size), sort_keys=True)
+    key = "%s:%dx%d:%d:%s" % (digest, int(size['width']), int(size['height']), int(bool(crop)),
+                              hashlib.sha1(profile).hexdigest()[:12])
+    if image_format:
+        key = "%s:%s" % (key, image_format.lower())
+    return key
+
+
+class DerivativeIndex(object):
+    """
+    Maps derivative keys to the names and metadata of already stored derivatives and counts hits and misses.
+
+    Subclasses implement `_get`, returning a ``(name, metadata)`` pair, and `_set`.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        ``(name, metadata)`` of the derivative stored for ``key``, or ``(None, None)``
+        """
+        name, metadata = self._get(key)
+        with self._lock:
+            if name:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return name, metadata
+
+    def set(self, key, name, metadata=None):
+        self._set(key, name, metadata or {})
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, name, metadata):
+        raise NotImplementedError
+
+
+class CacheDerivativeIndex(DerivativeIndex):
+    """
+    Keeps the index in the Django cache named by MEDIA_PIPELINE["DERIVATIVE_INDEX_CACHE"]
+    """
+    key_prefix = "derivative:"
+
+    def __init__(self):
+        super(CacheDerivativeIndex, self).__init__()
+        self.cache = get_cache(MEDIA_PIPELINE["DERIVATIVE_INDEX_CACHE"])
+
+    def _get(self, key):
+        entry = self.cache.get(self.key_prefix + key)
+        if isinstance(entry, basestring):
+            # Entries written before metadata was indexed
+            return entry, None
+        return entry or (None, None)
+
+    def _set(self, key, name, metadata):
+        self.cache.set(self.key_prefix + key, (name, metadata), MEDIA_PIPELINE["DERIVATIVE_INDEX_TIMEOUT"])
+
+
+class DatabaseDerivativeIndex(DerivativeIndex):
+    """
+    Keeps the index in the table of the DerivativeIndexEntry subclass named by
+    MEDIA_PIPELINE["DERIVATIVE_INDEX_MODEL"]
+    """
+    def __init__(self):
+        super(DatabaseDerivativeIndex, self).__init__()
+        model_label = MEDIA_PIPELINE["DERIVATIVE_INDEX_MODEL"]
+        self.model = get_model(*model_label.split(".")) if model_label else None
+        if self.model is None:
+            raise ImproperlyConfigured("DatabaseDerivativeIndex needs MEDIA_PIPELINE[\"DERIVATIVE_INDEX_MODEL\"] "
+                                       "to name a concrete DerivativeIndexEntry subclass")
+
+    def _get(self, key):
+        entries = self.model._default_manager.filter(key=key).values_list("name", "metadata")[:1]
+        if not entries:
+            return None, None
+        name, metadata = entries[0]
+        return name, json.loads(metadata) if metadata else None
+
+    def _set(self, key, name, metadata):
+        metadata = json.dumps(metadata, sort_keys=True)
+        updated = self.model._default_manager.filter(key=key).update(name=name, metadata=metadata)
+        if not updated:
+            try:
+                self.model._default_manager.create(key=key, name=name, metadata=metadata)
+            except IntegrityError:
+                # Another worker stored the same derivative first
+                pass
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_derivative_index():
+    """
+    The configured DerivativeIndex, or None when MEDIA_PIPELINE["DERIVATIVE_INDEX"] is not set
+    """
+    global _index
+    if not MEDIA_PIPELINE["DERIVATIVE_INDEX"]:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = get_class(MEDIA_PIPELINE["DERIVATIVE_INDEX"])()
+    return _index
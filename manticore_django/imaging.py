@@ -0,0 +1,364 @@
+import mmap
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+import tempfile
+from tempfile import SpooledTemporaryFile
+
+from PIL import Image
+from django.core.files.uploadedfile import UploadedFile
+
+from manticore_django.manticore_django.media_settings import MEDIA_PIPELINE
+
+
+class ImageRejected(Exception):
+    """
+    Raised when an original is too large to decode, or no decode budget frees up in time
+    """
+    pass
+
+
+ImageInfo = namedtuple('ImageInfo', ['width', 'height', 'mode', 'format'])
+
+# Bytes per pixel of the decoded image for each mode, anything unlisted is assumed to be 4
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'LA': 2, 'I;16': 2, 'RGB': 3, 'YCbCr': 3, 'LAB': 3, 'HSV': 3}
+
+
+def probe_image(file):
+    """
+    Opens ``file`` reading only its header and returns ``(image, ImageInfo)``.
+
+    Nothing is decoded until the returned image is loaded, so the same image should be handed on for rendering.
+    """
+    image = Image.open(file)
+    return image, ImageInfo(image.size[0], image.size[1], image.mode, image.format)
+
+
+def estimate_decode_bytes(info, plan):
+    """
+    Memory needed to decode an original described by ``info`` for ``plan``, taking JPEG draft scaling into account
+    """
+    width, height = info.width, info.height
+    if info.format == 'JPEG' and plan:
+        target_width, target_height = plan[0][1]
+        scale = 1
+        while scale < 8 and width // (scale * 2) >= target_width * 2 and height // (scale * 2) >= target_height * 2:
+            scale *= 2
+        width, height = (width + scale - 1) // scale, (height + scale - 1) // scale
+    return width * height * MODE_BYTES.get(info.mode, 4)
+
+
+class DecodeAdmission(object):
+    """
+    Limits the pixel memory of decodes running at once in this process.
+
+    Decodes larger than the whole budget are rejected straight away. Others wait until enough of the budget
+    is free, and are rejected if that takes longer than the timeout.
+    """
+    def __init__(self, budget, timeout):
+        self.budget = budget
+        self.timeout = timeout
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def admit(self, needed):
+        if self.budget and needed > self.budget:
+            raise ImageRejected("Decoding needs %d bytes, over the %d byte budget" % (needed, self.budget))
+
+        with self._condition:
+            deadline = time.time() + self.timeout
+            while self.budget and self.in_use + needed > self.budget:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ImageRejected("Timed out waiting for %d bytes of decode budget" % needed)
+                self._condition.wait(remaining)
+            self.in_use += needed
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_use -= needed
+                self._condition.notify_all()
+
+
+decode_admission = DecodeAdmission(MEDIA_PIPELINE["DECODE_MEMORY_BUDGET"], MEDIA_PIPELINE["DECODE_ADMISSION_TIMEOUT"])
+
+
+def check_image_info(info):
+    """
+    Rejects originals over MEDIA_PIPELINE["MAX_IMAGE_PIXELS"] before anything is decoded
+    """
+    max_pixels = MEDIA_PIPELINE["MAX_IMAGE_PIXELS"]
+    if max_pixels and info.width * info.height > max_pixels:
+        raise ImageRejected("%dx%d image is over the %d pixel limit" % (info.width, info.height, max_pixels))
+
+
+def plan_thumbnail_sizes(image_size, sizes, crop=False):
+    """
+    Works out the resized dimensions and crop box for each entry in ``sizes``
+    against an original of ``image_size``.
+
+    Returns a list of ``(size_name, (width, height), crop_box)`` ordered from
+    the largest derivative to the smallest. ``crop_box`` is None when not cropping.
+    """
+    (x_size, y_size) = image_size
+    original_ratio = float(x_size) / float(y_size)
+
+    plan = []
+    for size_name, size in sizes.iteritems():
+        width = size['width']
+        height = size['height']
+        new_ratio = float(width / height)
+        crop_box = None
+        if new_ratio > original_ratio:
+            resized = (width, int(width / original_ratio))
+            if crop:
+                clip_amount = int((int(width / original_ratio) - height) / 2)
+                crop_box = (0, clip_amount, width, height + clip_amount)
+        else:
+            resized = (int(height * original_ratio), height)
+            if crop:
+                clip_amount = int((int(height * original_ratio) - width) / 2)
+                crop_box = (clip_amount, 0, width + clip_amount, height)
+        plan.append((size_name, resized, crop_box))
+
+    plan.sort(key=lambda entry: entry[1][0] * entry[1][1], reverse=True)
+    return plan
+
+
+def decode_for_plan(image, plan):
+    """
+    Decodes ``image`` once, as close as possible to the largest size in ``plan``.
+
+    JPEGs are decoded straight at a reduced scale with ``Image.draft``; other
+    formats are shrunk by an integer factor with ``Image.reduce`` when Pillow
+    provides it. Both keep at least twice the target resolution so the final
+    antialiased resize still has enough detail to work with.
+    """
+    if not plan:
+        image.load()
+        return image
+
+    target_width, target_height = plan[0][1]
+    x_size, y_size = image.size
+
+    if image.format == 'JPEG':
+        image.draft(image.mode, (target_width * 2, target_height * 2))
+        image.load()
+        return image
+
+    image.load()
+    factor = min(x_size // (target_width * 2), y_size // (target_height * 2))
+    if factor >= 2 and hasattr(image, 'reduce'):
+        image = image.reduce(factor)
+    return image
+
+
+def render_thumbnails(image, plan):
+    """
+    Yields ``(size_name, image)`` for every entry of ``plan``.
+
+    Each size is resampled from the previous (uncropped) output rather than from
+    the original, largest first, so the full resolution image is only resampled once.
+    Every resized derivative keeps the original's aspect ratio, which is what makes
+    cascading safe.
+    """
+    current = decode_for_plan(image, plan)
+    for size_name, resized, crop_box in plan:
+        if current.size != resized:
+            current = current.resize(resized, Image.ANTIALIAS)
+        im = current
+        if crop_box:
+            im = im.crop(crop_box)
+        yield size_name, im
+
+
+def spooled_buffer():
+    """
+    A temporary buffer that stays in memory up to MEDIA_PIPELINE["SPOOL_MAX_MEMORY"] bytes and spills to disk after
+    """
+    return SpooledTemporaryFile(max_size=MEDIA_PIPELINE["SPOOL_MAX_MEMORY"])
+
+
+def incoming_upload(original_file):
+    """
+    The UploadedFile ``original_file`` was assigned from in this request, if the field still holds it.
+
+    Reading it avoids downloading the original back from storage right after it was uploaded.
+    """
+    upload = getattr(original_file, "_file", None)
+    if isinstance(upload, UploadedFile) and not getattr(upload, "closed", False):
+        return upload
+    return None
+
+
+def local_path(original_file, local_copy=None):
+    """
+    Path of a local copy of ``original_file`` if there is one, otherwise None
+    """
+    if local_copy and os.path.isfile(local_copy):
+        return local_copy
+
+    upload = incoming_upload(original_file)
+    if hasattr(upload, "temporary_file_path"):
+        return upload.temporary_file_path()
+
+    try:
+        path = original_file.path
+    except (AttributeError, NotImplementedError, ValueError):
+        return None
+    return path if os.path.isfile(path) else None
+
+
+def open_original(original_file, local_copy=None):
+    """
+    Returns a seekable buffer over the bytes of ``original_file``.
+
+    Local files, including ``local_copy`` and temporary uploads, are memory mapped so the page cache holds them
+    instead of the worker's heap. In-memory uploads are copied from the request. Only when neither is available
+    is the original streamed back from storage, chunk by chunk into a spooled buffer.
+    """
+    path = local_path(original_file, local_copy)
+    if path:
+        with open(path, "rb") as f:
+            try:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # Empty files can't be mapped
+                pass
+
+    source = incoming_upload(original_file) or original_file
+    buffer = spooled_buffer()
+    for chunk in source.chunks():
+        buffer.write(chunk)
+    buffer.seek(0)
+    return buffer
+
+
+def stash_upload(original_file):
+    """
+    Keeps a copy of the incoming upload in MEDIA_PIPELINE["UPLOAD_STASH_DIR"] for a deferred task to read.
+
+    Temporary uploads are hard linked when the stash is on the same filesystem. Returns the stashed path, or
+    None when there is no upload or no stash directory.
+    """
+    upload = incoming_upload(original_file)
+    stash_dir = MEDIA_PIPELINE["UPLOAD_STASH_DIR"]
+    if upload is None or not stash_dir:
+        return None
+
+    fd, path = tempfile.mkstemp(dir=stash_dir, suffix=os.path.splitext(upload.name or "")[1])
+    os.close(fd)
+    if hasattr(upload, "temporary_file_path"):
+        try:
+            os.unlink(path)
+            os.link(upload.temporary_file_path(), path)
+            return path
+        except OSError:
+            pass
+
+    with open(path, "wb") as f:
+        for chunk in upload.chunks():
+            f.write(chunk)
+    return path
+
+
+# Extension and content type stored for each output format
+FORMATS = {
+    'JPEG': ('jpg', 'image/jpeg'),
+    'PNG': ('png', 'image/png'),
+    'WEBP': ('webp', 'image/webp'),
+}
+
+
+def get_encoder_profile(size):
+    """
+    Encoder settings for a SIZES entry: MEDIA_PIPELINE["ENCODER_PROFILE"] overridden by the entry's ``encoder`` dict.
+
+    A profile has ``format``, ``quality``, ``progressive``, ``optimize``, ``subsampling`` and ``alternates``,
+    a list of partial profiles for sibling variants (e.g. ``[{"format": "WEBP", "quality": 80}]``).
+    """
+    profile = {'format': 'JPEG'}
+    profile.update(MEDIA_PIPELINE["ENCODER_PROFILE"])
+    profile.update(size.get('encoder', {}))
+    profile['format'] = profile['format'].upper()
+    return profile
+
+
+def get_alternate_profiles(profile):
+    alternates = []
+    for alternate in profile.get('alternates') or []:
+        alternate_profile = dict(profile, alternates=[])
+        alternate_profile.update(alternate)
+        alternate_profile['format'] = alternate_profile['format'].upper()
+        alternates.append(alternate_profile)
+    return alternates
+
+
+def encode_image(im, profile, fp):
+    """
+    Saves ``im`` to ``fp`` with the options of ``profile``
+    """
+    image_format = profile['format']
+    if image_format == 'JPEG' and im.mode != "RGB":
+        im = im.convert("RGB")
+    elif image_format in ('PNG', 'WEBP') and im.mode not in ("RGB", "RGBA"):
+        im = im.convert("RGBA" if 'transparency' in im.info or im.mode in ("LA", "PA") else "RGB")
+
+    options = {}
+    for option in ('quality', 'progressive', 'optimize', 'subsampling'):
+        if profile.get(option) is not None:
+            options[option] = profile[option]
+    if image_format == 'PNG':
+        options.pop('quality', None)
+        options.pop('progressive', None)
+        options.pop('subsampling', None)
+    im.save(fp, image_format, **options)
+
+
+class _ByteCounter(object):
+    """
+    Write-only file that only counts what is written to it
+    """
+    def __init__(self):
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+
+    def flush(self):
+        pass
+
+
+_encoder_report = {}
+_encoder_report_lock = threading.Lock()
+
+
+def record_encoder_savings(size_name, im, encoded_bytes):
+    """
+    Adds the difference between ``encoded_bytes`` and a default ``im.save(fp, 'JPEG')`` to the encoder report
+    """
+    baseline = _ByteCounter()
+    encode_image(im, {'format': 'JPEG'}, baseline)
+    with _encoder_report_lock:
+        entry = _encoder_report.setdefault(size_name, {'images': 0, 'baseline_bytes': 0, 'bytes': 0})
+        entry['images'] += 1
+        entry['baseline_bytes'] += baseline.count
+        entry['bytes'] += encoded_bytes
+
+
+def encoder_report():
+    """
+    Per size totals of encoded bytes against Pillow's default JPEG encoding, with the bytes saved.
+
+    Only collected while MEDIA_PIPELINE["ENCODER_REPORT"] is on.
+    """
+    with _encoder_report_lock:
+        report = {}
+        for size_name, entry in _encoder_report.iteritems():
+            report[size_name] = dict(entry, bytes_saved=entry['baseline_bytes'] - entry['bytes'])
+        return report
@@ -0,0 +1,61 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from manticore_django.manticore_django import benchmarks
+from manticore_django.manticore_django.utils import get_model
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the Media image pipeline on synthetic originals and compares the results to a baseline"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--model", default=None,
+                    help="app_label.ModelName whose SIZES are benchmarked instead of the default thumbnail sizes"),
+        make_option("--repeat", type="int", default=3,
+                    help="Runs per case, the best of which is kept"),
+        make_option("--baseline", default="media_pipeline_baseline.json",
+                    help="Baseline file to compare against"),
+        make_option("--save-baseline", action="store_true", default=False,
+                    help="Write this run's results to the baseline file instead of comparing"),
+        make_option("--tolerance", type="float", default=0.2,
+                    help="Fraction a metric may exceed its baseline before it is reported as a regression"),
+        make_option("--timeout", type="int", default=600,
+                    help="Seconds a single run may take before the benchmark fails"),
+    )
+
+    def handle(self, *args, **options):
+        sizes = None
+        if options["model"]:
+            model = get_model(*options["model"].split("."))
+            if model is None or not hasattr(model, "SIZES"):
+                raise CommandError("%s has no SIZES" % options["model"])
+            sizes = model.SIZES
+
+        try:
+            results = benchmarks.run_benchmarks(sizes=sizes, repeat=options["repeat"], log=self.log,
+                                                model_label=options["model"], timeout=options["timeout"])
+        except benchmarks.BenchmarkError as exc:
+            raise CommandError("Benchmark failed: %s" % exc)
+
+        if options["save_baseline"]:
+            benchmarks.save_baseline(options["baseline"], results)
+            self.stdout.write("Saved baseline to %s\n" % options["baseline"])
+            return
+
+        try:
+            baseline = benchmarks.load_baseline(options["baseline"])
+        except IOError:
+            self.stdout.write("No baseline at %s, run with --save-baseline to create one\n" % options["baseline"])
+            return
+
+        regressions = benchmarks.compare(results, baseline, options["tolerance"])
+        for key, metric, previous, current in regressions:
+            self.stdout.write("REGRESSION %s %s: %.3f -> %.3f\n" % (key, metric, previous, current))
+        if regressions:
+            raise CommandError("%d regressions against %s" % (len(regressions), options["baseline"]))
+        self.stdout.write("No regressions against %s\n" % options["baseline"])
+
+    def log(self, key, result):
+        self.stdout.write("%-40s wall %.3fs  cpu %.3fs  peak +%d KB\n" % (
+            key, result["wall"], result["cpu"], result["peak_rss_kb"]))
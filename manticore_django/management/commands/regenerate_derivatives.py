@@ -0,0 +1,121 @@
+import json
+import os
+import time
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from manticore_django.manticore_django.bulk import init_worker, regenerate_worker
+from manticore_django.manticore_django.models import Media
+from manticore_django.manticore_django.utils import get_models
+
+
+class Command(BaseCommand):
+    help = "Regenerates the SIZES derivatives of every concrete Media model, resuming from a checkpoint file"
+    args = "[app_label.ModelName ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", default=500,
+                    help="Number of rows read per primary-key batch"),
+        make_option("--processes", type="int", default=4,
+                    help="Number of worker processes rendering and uploading derivatives"),
+        make_option("--rate", type="float", default=0,
+                    help="Maximum images per second handed to the workers, to throttle storage uploads. 0 is unlimited"),
+        make_option("--checkpoint", default="regenerate_derivatives.json",
+                    help="File recording the last primary key processed for each unfinished model"),
+        make_option("--restart", action="store_true", default=False,
+                    help="Ignore the checkpoint file and start from the first row"),
+    )
+
+    def handle(self, *labels, **options):
+        models = self.get_media_models(labels)
+        checkpoint_path = options["checkpoint"]
+        checkpoint = {} if options["restart"] else self.read_checkpoint(checkpoint_path)
+
+        connection.close()
+        pool = Pool(options["processes"], initializer=init_worker)
+        self.processed, self.failed = 0, 0
+        self.started = time.time()
+        try:
+            for model in models:
+                label = "%s.%s" % (model._meta.app_label, model._meta.object_name)
+                for last_pk in self.process_model(model, pool, checkpoint.get(label), options):
+                    checkpoint[label] = last_pk
+                    self.write_checkpoint(checkpoint_path, checkpoint)
+                # Finished, so the next backfill of this model starts from its first row again
+                if checkpoint.pop(label, None) is not None:
+                    self.write_checkpoint(checkpoint_path, checkpoint)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.stdout.write("Done: %d images, %d failed, %.1f images/sec\n" % (self.processed, self.failed, self.rate()))
+
+    def get_media_models(self, labels):
+        models = [model for model in get_models() if issubclass(model, Media) and not model._meta.abstract]
+        if labels:
+            wanted = set(label.lower() for label in labels)
+            models = [model for model in models
+                      if ("%s.%s" % (model._meta.app_label, model._meta.object_name)).lower() in wanted]
+            if len(models) != len(wanted):
+                raise CommandError("Unknown Media models in %s" % ", ".join(labels))
+        return models
+
+    def process_model(self, model, pool, last_pk, options):
+        """
+        Regenerates one model in primary-key batches, yielding the last primary key of each finished batch
+        """
+        original_file_name = getattr(model, "original_file_name", "original_file")
+        queryset = model._default_manager.exclude(**{original_file_name: ""}).exclude(**{original_file_name: None})
+        queryset = queryset.exclude(media_type=Media.TYPE_CHOICES.video).order_by("pk")
+
+        min_interval = 1.0 / options["rate"] if options["rate"] else 0
+        while True:
+            batch = queryset
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            pks = list(batch.values_list("pk", flat=True)[:options["batch_size"]])
+            if not pks:
+                return
+
+            results = []
+            for pk in pks:
+                if min_interval:
+                    time.sleep(max(0, self.started + (self.processed + len(results)) * min_interval - time.time()))
+                args = (model._meta.app_label, model._meta.object_name, pk)
+                results.append(pool.apply_async(regenerate_worker, (args,)))
+
+            for result in results:
+                pk, error = result.get()
+                self.processed += 1
+                if error:
+                    self.failed += 1
+                    self.stderr.write("Failed %s %s:\n%s\n" % (model._meta.object_name, pk, error))
+
+            last_pk = pks[-1]
+            self.stdout.write("%s up to pk %s: %d images, %d failed, %.1f images/sec\n" % (
+                model._meta.object_name, last_pk, self.processed, self.failed, self.rate()))
+            yield last_pk
+
+    def rate(self):
+        elapsed = time.time() - self.started
+        return self.processed / elapsed if elapsed else 0
+
+    def read_checkpoint(self, path):
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def write_checkpoint(self, path, checkpoint):
+        if not checkpoint:
+            if os.path.exists(path):
+                os.unlink(path)
+            return
+        # Write then rename so an interruption never leaves a truncated checkpoint
+        temp_path = "%s.tmp" % path
+        with open(temp_path, "w") as f:
+            json.dump(checkpoint, f)
+        os.rename(temp_path, path)
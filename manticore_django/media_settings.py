@@ -0,0 +1,50 @@
+from django.conf import settings
+
+
+MEDIA_PIPELINE = {
+    # Generate derivatives in a Celery task instead of inside the model save
+    "DEFER_THUMBNAILS": False,
+    # URL served for a size while its derivative is still being generated. None falls back to the original file
+    "PLACEHOLDER_URL": None,
+    # Number of threads uploading rendered derivatives while the next size is resized
+    "UPLOAD_THREADS": 3,
+    # Bytes an original or encoded derivative may hold in memory before its buffer spills to a temporary file
+    "SPOOL_MAX_MEMORY": 5 * 1024 * 1024,
+    # Dotted path of the DerivativeIndex used to reuse derivatives of identical originals. None disables it.
+    # manticore_django.derivative_cache provides CacheDerivativeIndex and DatabaseDerivativeIndex
+    "DERIVATIVE_INDEX": None,
+    # app_label.ModelName of your DerivativeIndexEntry subclass, where DatabaseDerivativeIndex keeps its entries
+    "DERIVATIVE_INDEX_MODEL": None,
+    "DERIVATIVE_INDEX_CACHE": "default",
+    "DERIVATIVE_INDEX_TIMEOUT": 30 * 24 * 60 * 60,
+    # Cache recording where on-demand derivatives were stored, and how long a first render may take
+    "LAZY_RENDER_CACHE": "default",
+    "LAZY_RENDER_CACHE_TIMEOUT": 30 * 24 * 60 * 60,
+    "LAZY_RENDER_TIMEOUT": 30,
+    # {"app_label.ModelName": [size names]} the on-demand derivative view may render. Anything else is a 404
+    "LAZY_RENDER_MODELS": {},
+    # (renders, seconds) the view starts at most per client address. None disables the limit
+    "LAZY_RENDER_RATE": (30, 60),
+    # Directory shared with Celery workers where uploads are stashed for deferred processing, so workers
+    # don't download originals back from storage. None disables stashing
+    "UPLOAD_STASH_DIR": None,
+    # Originals with more pixels than this are rejected from their header alone. None disables the check
+    "MAX_IMAGE_PIXELS": 100 * 1000 * 1000,
+    # Bytes of decoded pixels allowed at once per process, and seconds a decode waits for budget before failing
+    "DECODE_MEMORY_BUDGET": 512 * 1024 * 1024,
+    "DECODE_ADMISSION_TIMEOUT": 60,
+    # Default encoder settings for derivatives. SIZES entries can override them with an "encoder" dict
+    "ENCODER_PROFILE": {
+        "format": "JPEG",
+        "quality": None,
+        "progressive": False,
+        "optimize": False,
+        "subsampling": None,
+        "alternates": [],
+    },
+    # Collect imaging.encoder_report() figures. Costs one extra default JPEG encode per derivative
+    "ENCODER_REPORT": False,
+}
+
+if hasattr(settings, "MEDIA_PIPELINE"):
+    MEDIA_PIPELINE.update(settings.MEDIA_PIPELINE)
@@ -1,10 +1,22 @@
-import StringIO
 from django.db.models.signals import pre_save
+import hashlib
+import json
 import os
+import threading
+import time
 from PIL import Image
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.db import models
-from manticore_django.manticore_django.utils import retry_cloudfiles
+from django.core.files.uploadedfile import UploadedFile
+from django.core.urlresolvers import reverse
+from django.db import models, transaction
+from manticore_django.manticore_django.derivative_cache import content_digest, derivative_key, get_derivative_index
+from manticore_django.manticore_django.imaging import (FORMATS, ImageInfo, check_image_info, decode_admission,
+                                                       encode_image, estimate_decode_bytes, get_alternate_profiles,
+                                                       get_encoder_profile, open_original, plan_thumbnail_sizes,
+                                                       probe_image, record_encoder_savings, render_thumbnails,
+                                                       spooled_buffer, stash_upload)
+from manticore_django.manticore_django.media_settings import MEDIA_PIPELINE
+from manticore_django.manticore_django.signals import derivatives_generated, derivatives_skipped
+from manticore_django.manticore_django.utils import get_cache, get_thread_pool, retry_cloudfiles
 from model_utils import Choices
 
 
@@ -23,15 +35,186 @@ class Media(CoreModel):
         (0, 'image', 'Image'),
         (1, 'video', 'Video')
     )
+    PROCESSING_CHOICES = Choices(
+        (0, 'done', 'Done'),
+        (1, 'pending', 'Pending'),
+        (2, 'processing', 'Processing'),
+        (3, 'failed', 'Failed')
+    )
     media_type = models.PositiveSmallIntegerField(choices=TYPE_CHOICES, blank=True, null=True)
     original_file = models.FileField(upload_to='media/original/', blank=True, null=True)
     thumbnail = models.FileField(upload_to='media/thumbnail/', blank=True, null=True)
     large_photo = models.FileField(upload_to='media/large_photo/', blank=True, null=True)
+    processing_state = models.PositiveSmallIntegerField(choices=PROCESSING_CHOICES,
+                                                        default=PROCESSING_CHOICES.done)
+    sizes_signature = models.CharField(max_length=40, blank=True, editable=False)
+    variants = models.TextField(blank=True, editable=False)
+    file_metadata = models.TextField(blank=True, editable=False)
     original_file_name = "original_file"
+    defer_thumbnails = MEDIA_PIPELINE["DEFER_THUMBNAILS"]
 
     class Meta:
         abstract = True
 
+    def __init__(self, *args, **kwargs):
+        super(Media, self).__init__(*args, **kwargs)
+        remember_original_file(self)
+
+    def save(self, *args, **kwargs):
+        super(Media, self).save(*args, **kwargs)
+        remember_original_file(self)
+        if getattr(self, "_derivatives_pending", False):
+            self._derivatives_pending = False
+            enqueue_derivatives(self)
+
+    def size_url(self, size_name):
+        """
+        URL for the `size_name` derivative, falling back to the placeholder or the original while it is generated
+        """
+        size_file = getattr(self, size_name)
+        # Until processing is done the field may still hold the derivative of a replaced original
+        if size_file and self.processing_state == self.PROCESSING_CHOICES.done:
+            return size_file.url
+
+        if MEDIA_PIPELINE["PLACEHOLDER_URL"]:
+            return MEDIA_PIPELINE["PLACEHOLDER_URL"]
+
+        original_file = getattr(self, getattr(self, "original_file_name", "original_file"))
+        if original_file:
+            return original_file.url
+        return None
+
+    def get_variants(self):
+        """
+        Alternate encodings of each size as ``{size_name: {format: stored name}}``
+        """
+        return json.loads(self.variants) if self.variants else {}
+
+    def set_variants(self, variants):
+        merged = self.get_variants()
+        for size_name, formats in variants.iteritems():
+            merged.setdefault(size_name, {}).update((image_format, name) for image_format, name in formats.iteritems()
+                                                    if name)
+        self.variants = json.dumps(merged, sort_keys=True)
+
+    def get_file_metadata(self, name=None):
+        """
+        Width, height, bytes, content type and etag recorded for the original file or a derivative, keyed by
+        field name (or "size_name:FORMAT" for alternates). Without `name`, all of them. Never touches storage.
+        """
+        metadata = json.loads(self.file_metadata) if self.file_metadata else {}
+        if name is None:
+            return metadata
+        return metadata.get(name, {})
+
+    def set_file_metadata(self, metadata):
+        merged = self.get_file_metadata()
+        merged.update((name, file_metadata) for name, file_metadata in metadata.iteritems() if file_metadata)
+        self.file_metadata = json.dumps(merged, sort_keys=True, separators=(",", ":"))
+
+    def variant_url(self, size_name, image_format):
+        """
+        URL of the `image_format` alternate of `size_name` (e.g. "WEBP"), or None if there isn't one or it is
+        being generated
+        """
+        name = self.get_variants().get(size_name, {}).get(image_format.upper())
+        if not name or self.processing_state != self.PROCESSING_CHOICES.done:
+            return None
+        return derivative_storage(self, size_name).url(name)
+
+    def lazy_size_url(self, size_name):
+        """
+        URL of the view that renders the `size_name` derivative on first request and redirects to it afterwards
+        """
+        return reverse("media_derivative", kwargs={
+            "app_label": self._meta.app_label,
+            "model_name": self._meta.object_name.lower(),
+            "pk": self.pk,
+            "size_name": size_name,
+        })
+
+
+class DerivativeIndexEntry(CoreModel):
+    """
+    Stored derivative for one original digest and size spec, used by derivative_cache.DatabaseDerivativeIndex.
+
+    Abstract like Media, so only projects using the database index get its table: subclass it in one of your apps
+    and name the subclass in MEDIA_PIPELINE["DERIVATIVE_INDEX_MODEL"].
+    """
+    key = models.CharField(max_length=128, unique=True)
+    name = models.CharField(max_length=255)
+    metadata = models.TextField(blank=True)
+
+    class Meta:
+        abstract = True
+
+    def __unicode__(self):
+        return self.key
+
+
+def enqueue_derivatives(instance):
+    """
+    Queues the Celery task that fills in the SIZES fields once the row is committed
+    """
+    from manticore_django.manticore_django.tasks import generate_media_derivatives
+
+    original_file = getattr(instance, getattr(instance, "original_file_name", "original_file"))
+    # Stashed by resize_model_photos, before saving the row committed the upload to storage
+    local_copy = getattr(instance, "_stashed_upload", None)
+    instance._stashed_upload = None
+
+    def send():
+        generate_media_derivatives.delay(instance._meta.app_label, instance._meta.object_name, instance.pk,
+                                         local_copy=local_copy, original_name=original_file.name)
+
+    run_on_commit(send)
+
+
+def run_on_commit(func):
+    """
+    Calls ``func`` once the current transaction commits, or right away on Django versions without on_commit
+    """
+    on_commit = getattr(transaction, "on_commit", None)
+    if on_commit:
+        on_commit(func)
+    else:
+        func()
+
+
+def get_sizes_signature(instance, crop=False):
+    """
+    Fingerprint of the model's SIZES, stored on each row so changed specs are picked up
+    """
+    specs = sorted((size_name, int(size['width']), int(size['height']), sorted(get_encoder_profile(size).items()))
+                   for size_name, size in instance.SIZES.iteritems())
+    return hashlib.sha1(repr((specs, bool(crop)))).hexdigest()
+
+
+def remember_original_file(instance):
+    """
+    Records the name of the stored original so later saves can tell whether it was replaced
+    """
+    # Read from __dict__ so a deferred original_file isn't fetched just to remember it
+    original_file = instance.__dict__.get(getattr(instance, "original_file_name", "original_file"))
+    instance._loaded_original_name = getattr(original_file, "name", original_file) or None
+
+
+def derivatives_outdated_reason(instance):
+    """
+    Why the instance's derivatives need to be regenerated, or None when they are up to date
+    """
+    original_file = getattr(instance, getattr(instance, "original_file_name", "original_file"))
+    if not getattr(original_file, "_committed", True):
+        return "new_upload"
+    if (original_file.name or None) != getattr(instance, "_loaded_original_name", None):
+        return "original_changed"
+    if hasattr(instance, "sizes_signature") and instance.sizes_signature != get_sizes_signature(instance):
+        return "sizes_changed"
+    for size_name in instance.SIZES:
+        if not getattr(instance, size_name):
+            return "missing_size"
+    return None
+
 
 def resize_model_photos(instance, force_insert, force_update):
     """
@@ -55,19 +238,236 @@ def resize_model_photos(instance, force_insert, force_update):
             setattr(instance, size_name, '')
         return
 
-    process_thumbnail(instance, original_file, instance.SIZES)
+    reason = derivatives_outdated_reason(instance)
+    if reason is None:
+        derivatives_skipped.send(sender=instance.__class__, instance=instance, reason="unchanged")
+        return
+
+    if getattr(instance, "defer_thumbnails", False):
+        instance.processing_state = instance.PROCESSING_CHOICES.pending
+        instance._derivatives_pending = True
+        instance._stashed_upload = stash_upload(original_file)
+        return
+
+    generate_derivatives(instance)
+
+
+def generate_derivatives(instance, local_copy=None, save=True):
+    """
+    Renders and stores every SIZES derivative for the instance's original file, reading it from `local_copy`
+    when given. With `save` off the instance is left for the caller to save
+    """
+    original_file_field_name = getattr(instance, "original_file_name", "original_file")
+    original_file = getattr(instance, original_file_field_name)
+    if hasattr(instance, "sizes_signature"):
+        instance.sizes_signature = get_sizes_signature(instance)
+    process_thumbnail(instance, original_file, instance.SIZES, local_copy=local_copy, save=save)
+    derivatives_generated.send(sender=instance.__class__, instance=instance, sizes=instance.SIZES.keys())
 
 
-def process_thumbnail(instance, original_file, sizes, crop=False):
+def regenerate_media(model, pk, local_copy=None, original_name=None):
+    """
+    Loads one Media row and regenerates all of its derivatives, tracking progress in `processing_state`.
+
+    `local_copy` is a stashed copy of the upload named `original_name`. It is only used, and then removed,
+    if the row still points at that original.
+
+    Returns False if the row no longer exists.
+    """
+    try:
+        try:
+            instance = model._default_manager.get(pk=pk)
+        except model.DoesNotExist:
+            return False
+
+        original_file = getattr(instance, getattr(instance, "original_file_name", "original_file"))
+        fresh = not original_name or original_file.name == original_name
+        return _regenerate_media(model, instance, local_copy if fresh else None)
+    finally:
+        if local_copy and os.path.exists(local_copy):
+            os.unlink(local_copy)
+
+
+def _regenerate_media(model, instance, local_copy):
+    pk = instance.pk
+    model._default_manager.filter(pk=pk).update(processing_state=Media.PROCESSING_CHOICES.processing)
+    try:
+        # Only the derivative fields are saved below, so edits made while rendering aren't overwritten
+        generate_derivatives(instance, local_copy, save=False)
+    except Exception:
+        model._default_manager.filter(pk=pk).update(processing_state=Media.PROCESSING_CHOICES.failed)
+        raise
+
+    instance.processing_state = Media.PROCESSING_CHOICES.done
+    instance.save(update_fields=instance.SIZES.keys() + ["processing_state", "sizes_signature", "variants",
+                                                         "file_metadata"])
+    return True
+
+
+def get_size_spec(instance, size_name):
+    """
+    Spec of `size_name` from the model's SIZES or LAZY_SIZES, or None if it isn't declared
+    """
+    for sizes in (getattr(instance, "SIZES", {}), getattr(instance, "LAZY_SIZES", {})):
+        if size_name in sizes:
+            return sizes[size_name]
+    return None
+
+
+def _lazy_derivative_digest(instance, size_name, size):
+    """
+    Hash naming the `size_name` derivative of the instance's current original, also used as its file name for sizes
+    that only exist in LAZY_SIZES
+    """
+    original_file = getattr(instance, getattr(instance, "original_file_name", "original_file"))
+    spec = "%dx%d" % (int(size['width']), int(size['height']))
+    profile = sorted(get_encoder_profile(size).items())
+    parts = (instance._meta.app_label, instance._meta.object_name, instance.pk, size_name, spec, profile,
+             original_file.name)
+    return hashlib.md5(":".join(unicode(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+def _lazy_upload_name(instance, size_name, size, digest):
+    extension = FORMATS[get_encoder_profile(size)['format']][0]
+    return derivative_upload_name(instance, size_name, "%s.%s" % (digest, extension))
+
+
+def lazy_derivative_name(instance, size_name):
+    """
+    Stored name of the `size_name` derivative if it has already been rendered, otherwise None.
+
+    Sizes in SIZES are read from their field. Sizes only in LAZY_SIZES are stored under a name derived from the
+    original and the size spec, so they are found in storage even after MEDIA_PIPELINE["LAZY_RENDER_CACHE"]
+    forgot them.
+    """
+    size = get_size_spec(instance, size_name)
+    if size_name in getattr(instance, "SIZES", {}):
+        field_file = getattr(instance, size_name)
+        return field_file.name if field_file else None
+
+    cache = get_cache(MEDIA_PIPELINE["LAZY_RENDER_CACHE"])
+    digest = _lazy_derivative_digest(instance, size_name, size)
+    # Hashed so file names never produce keys memcached rejects
+    key = "lazy-derivative:%s" % digest
+    stored_name = cache.get(key)
+    if stored_name:
+        return stored_name
+    name = _lazy_upload_name(instance, size_name, size, digest)
+    if derivative_storage(instance, size_name).exists(name):
+        cache.set(key, name, MEDIA_PIPELINE["LAZY_RENDER_CACHE_TIMEOUT"])
+        return name
+    return None
+
+
+_lazy_render_locks = {}
+_lazy_render_locks_lock = threading.Lock()
+
+
+def render_lazy_derivative(instance, size_name):
+    """
+    Returns the stored name of the `size_name` derivative, rendering and storing it if this is the first request.
+
+    Sizes in SIZES are persisted on their field. Sizes only in LAZY_SIZES are stored under the name
+    lazy_derivative_name looks for, and remembered in the MEDIA_PIPELINE["LAZY_RENDER_CACHE"] cache. Concurrent
+    first requests for the same derivative are collapsed: threads of one process share a lock, and other
+    processes wait on a cache lock for the derivative to appear.
+    """
+    stored_name = lazy_derivative_name(instance, size_name)
+    if stored_name:
+        return stored_name
+
+    size = get_size_spec(instance, size_name)
+    cache = get_cache(MEDIA_PIPELINE["LAZY_RENDER_CACHE"])
+    digest = _lazy_derivative_digest(instance, size_name, size)
+    key = "lazy-derivative:%s" % digest
+
+    with _lazy_render_locks_lock:
+        local_lock = _lazy_render_locks.setdefault(key, threading.Lock())
+
+    with local_lock:
+        stored_name = cache.get(key)
+        if stored_name:
+            return stored_name
+
+        lock_key = key + ":lock"
+        timeout = MEDIA_PIPELINE["LAZY_RENDER_TIMEOUT"]
+        have_lock = cache.add(lock_key, 1, timeout)
+        if not have_lock:
+            # Another process is rendering it, wait for its result before rendering ourselves
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                time.sleep(0.1)
+                stored_name = cache.get(key)
+                if stored_name:
+                    return stored_name
+
+        try:
+            original_file = getattr(instance, getattr(instance, "original_file_name", "original_file"))
+            if size_name in getattr(instance, "SIZES", {}):
+                filename = os.path.basename(original_file.name).rsplit('.', 1)[0]
+            else:
+                filename = digest
+            file = open_original(original_file)
+            try:
+                original_image, info = probe_image(file)
+                check_image_info(info)
+                stored_names, variants, metadata = render_and_upload(instance, original_image, filename,
+                                                                     {size_name: size}, False)
+            finally:
+                file.close()
+
+            stored_name = stored_names.get(size_name)
+            if stored_name:
+                if size_name in getattr(instance, "SIZES", {}):
+                    setattr(instance, size_name, stored_name)
+                    update_fields = [size_name]
+                    if hasattr(instance, "variants") and variants:
+                        instance.set_variants(variants)
+                        update_fields.append("variants")
+                    if hasattr(instance, "file_metadata"):
+                        instance.set_file_metadata(metadata)
+                        update_fields.append("file_metadata")
+                    instance.save(update_fields=update_fields)
+                cache.set(key, stored_name, MEDIA_PIPELINE["LAZY_RENDER_CACHE_TIMEOUT"])
+            return stored_name
+        finally:
+            if have_lock:
+                cache.delete(lock_key)
+            with _lazy_render_locks_lock:
+                _lazy_render_locks.pop(key, None)
+
+
+def derivative_storage(instance, size_name):
+    """
+    Storage the `size_name` derivative is saved to: its own field's, or the original file's for LAZY_SIZES
+    """
+    if size_name in getattr(instance, "SIZES", {}):
+        return instance._meta.get_field(size_name).storage
+    return instance._meta.get_field(getattr(instance, "original_file_name", "original_file")).storage
+
+
+def derivative_upload_name(instance, size_name, name):
+    if size_name in getattr(instance, "SIZES", {}):
+        return instance._meta.get_field(size_name).generate_filename(instance, name)
+    # get_valid_name strips slashes, so only the file name goes through it
+    return "media/%s/%s" % (size_name, derivative_storage(instance, size_name).get_valid_name(name))
+
+
+def process_thumbnail(instance, original_file, sizes, crop=False, local_copy=None, save=True):
     """
     Makes a smart thumbnail
     """
-    file = StringIO.StringIO(original_file.read())
-    original_image = Image.open(file)  # open the image using PIL
+    file = open_original(original_file, local_copy)
+    try:
+        return _process_thumbnail(instance, file, original_file.name, sizes, crop, save)
+    finally:
+        file.close()
 
+
+def _process_thumbnail(instance, file, original_name, sizes, crop, save=True):
     # pull a few variables out of that full path
-    filename = os.path.basename(original_file.name).rsplit('.', 1)[0]
-    extension = os.path.basename(original_file.name).rsplit('.', 1)[1]  # the file extension
+    filename = os.path.basename(original_name).rsplit('.', 1)[0]
+    extension = os.path.basename(original_name).rsplit('.', 1)[1]  # the file extension
 
     # If there is no extension found try jpg
     if extension == '':
@@ -77,38 +477,148 @@ def process_thumbnail(instance, original_file, sizes, crop=False):
     if extension not in ['jpg', 'jpeg', 'gif', 'png']:
         return False
 
-    for size_name, size in sizes.iteritems():
-        im = original_image.copy()
-
-        (x_size, y_size) = im.size
-        original_ratio = float(x_size) / float(y_size)
-        width = size['width']
-        height = size['height']
-        new_ratio = float(width / height)
-        if new_ratio > original_ratio:
-            im = im.resize((width, int(width / original_ratio)), Image.ANTIALIAS)
-            if crop:
-                clip_amount = int((int(width / original_ratio) - height) / 2)
-                im = im.crop((0, clip_amount, width,height + clip_amount))
+    # Read only the header so oversized originals are rejected before anything is decoded
+    original_image, info = probe_image(file)
+    check_image_info(info)
+    instance._image_info = info
+
+    file.seek(0, os.SEEK_END)
+    original_bytes = file.tell()
+    metadata = {getattr(instance, "original_file_name", "original_file"): {
+        "width": info.width,
+        "height": info.height,
+        "bytes": original_bytes,
+        "content_type": Image.MIME.get(info.format),
+        "etag": content_digest(file, "md5"),
+    }}
+
+    # Reuse derivatives already stored for a byte-identical original
+    index = get_derivative_index()
+    keys, stored_names, variants = {}, {}, {}
+    if index:
+        digest = content_digest(file)
+        for size_name, size in sizes.iteritems():
+            keys[size_name] = derivative_key(digest, size, crop)
+            stored_names[size_name], metadata[size_name] = index.get(keys[size_name])
+            for profile in get_alternate_profiles(get_encoder_profile(size)):
+                image_format = profile['format']
+                keys[size_name, image_format] = derivative_key(digest, size, crop, image_format)
+                variant_key = metadata_key(size_name, image_format)
+                variant_name, metadata[variant_key] = index.get(keys[size_name, image_format])
+                variants.setdefault(size_name, {})[image_format] = variant_name
+    missing_sizes = dict((size_name, size) for size_name, size in sizes.iteritems()
+                         if not stored_names.get(size_name) or not all(variants.get(size_name, {}).values()))
+
+    if missing_sizes:
+        new_names, new_variants, new_metadata = render_and_upload(instance, original_image, filename, missing_sizes,
+                                                                  crop)
+        stored_names.update(new_names)
+        variants.update(new_variants)
+        metadata.update(new_metadata)
+        if index:
+            for size_name in missing_sizes:
+                if stored_names.get(size_name):
+                    index.set(keys[size_name], stored_names[size_name], metadata.get(size_name))
+                for image_format, variant_name in variants.get(size_name, {}).iteritems():
+                    if variant_name:
+                        index.set(keys[size_name, image_format], variant_name,
+                                  metadata.get(metadata_key(size_name, image_format)))
+
+    # Assign in SIZES order so the resulting instance doesn't depend on which upload finished first
+    for size_name in sizes:
+        stored_name = stored_names.get(size_name)
+        if stored_name:
+            setattr(instance, size_name, stored_name)
+    if hasattr(instance, "variants"):
+        instance.set_variants(variants)
+    if hasattr(instance, "file_metadata"):
+        instance.set_file_metadata(metadata)
+    if save:
+        instance.save()
+
+    return True
+
+
+def metadata_key(size_name, image_format=None):
+    """
+    Key of a derivative, or of one of its alternate formats, in Media.file_metadata
+    """
+    return "%s:%s" % (size_name, image_format) if image_format else size_name
+
+
+def render_and_upload(instance, original_image, filename, sizes, crop):
+    """
+    Renders ``sizes`` from ``original_image`` and uploads them with their encoder profiles, then closes
+    ``original_image``.
+
+    Returns the stored names keyed by size name, the stored alternate variants as
+    ``{size_name: {format: name}}`` and the metadata of every stored file keyed by `metadata_key`.
+    """
+    def destination(size_name, name):
+        return derivative_storage(instance, size_name), derivative_upload_name(instance, size_name, name)
+
+    return render_and_upload_to(destination, original_image, filename, sizes, crop)
+
+
+def render_and_upload_to(destination, original_image, filename, sizes, crop):
+    """
+    Same as render_and_upload, with ``destination(size_name, name)`` returning the ``(storage, upload name)``
+    each derivative is saved to. ``original_image`` is closed once every size is rendered.
+    """
+    plan = plan_thumbnail_sizes(original_image.size, sizes, crop=crop)
+    info = ImageInfo(original_image.size[0], original_image.size[1], original_image.mode, original_image.format)
+    pool = get_thread_pool("uploads", MEDIA_PIPELINE["UPLOAD_THREADS"])
+    uploads = []
+    try:
+        with decode_admission.admit(estimate_decode_bytes(info, plan)):
+            try:
+                _render_and_queue(destination, original_image, plan, filename, sizes, pool, uploads)
+            finally:
+                # Free the decoded pixels before their share of the budget can go to another decode
+                original_image.close()
+    finally:
+        for size_name, alternate_format, temp_file, file_metadata, result in uploads:
+            result.wait()
+            temp_file.close()
+
+    stored_names, variants, metadata = {}, {}, {}
+    for size_name, alternate_format, temp_file, file_metadata, result in uploads:
+        if alternate_format:
+            variants.setdefault(size_name, {})[alternate_format] = result.get()
         else:
-            im = im.resize((int(height * original_ratio), height), Image.ANTIALIAS)
-            if crop:
-                clip_amount = int((int(height * original_ratio) - width) / 2)
-                im = im.crop((clip_amount, 0, width + clip_amount, height))
+            stored_names[size_name] = result.get()
+        if result.get():
+            metadata[metadata_key(size_name, alternate_format)] = file_metadata
+    return stored_names, variants, metadata
+
 
-        name = "%s.jpg" % filename
-        tempfile_io = StringIO.StringIO()
-        if im.mode != "RGB":
-            im = im.convert("RGB")
-        im.save(tempfile_io, 'JPEG')
+def _render_and_queue(destination, original_image, plan, filename, sizes, pool, uploads):
+    for size_name, im in render_thumbnails(original_image, plan):
+        profile = get_encoder_profile(sizes[size_name])
+        for variant_profile in [profile] + get_alternate_profiles(profile):
+            extension, content_type = FORMATS[variant_profile['format']]
+            name = "%s.%s" % (filename, extension)
+            tempfile_io = spooled_buffer()
+            encode_image(im, variant_profile, tempfile_io)
+            if MEDIA_PIPELINE["ENCODER_REPORT"] and variant_profile is profile:
+                record_encoder_savings(size_name, im, tempfile_io.tell())
 
-        temp_file = InMemoryUploadedFile(tempfile_io, None, name, 'image/jpeg', tempfile_io.len, None)
+            file_metadata = {
+                "width": im.size[0],
+                "height": im.size[1],
+                "bytes": tempfile_io.tell(),
+                "content_type": content_type,
+                "etag": content_digest(tempfile_io, "md5"),
+            }
 
-        def save_image(temp_file, instance, size_name, name):
-            # Make sure we're at the beginning of the file for reading when saving
-            temp_file.seek(0)
-            getattr(instance, size_name).save(name, temp_file)
+            temp_file = UploadedFile(tempfile_io, name, content_type, file_metadata["bytes"])
+            storage, upload_name = destination(size_name, name)
+            result = pool.apply_async(retry_cloudfiles, (save_image, storage, upload_name, temp_file))
+            uploads.append((size_name, variant_profile is not profile and variant_profile['format'],
+                            temp_file, file_metadata, result))
 
-        retry_cloudfiles(save_image, temp_file, instance, size_name, name)
 
-    return True
\ No newline at end of file
+def save_image(storage, name, temp_file):
+    # Make sure we're at the beginning of the file for reading when saving
+    temp_file.seek(0)
+    return storage.save(name, temp_file)
@@ -0,0 +1,188 @@
+"""
+Local disk read-through cache of stored object bodies, shared by every worker process on a host.
+
+Entries are keyed by container, name and etag, so a changed object never serves a stale body. Old entries
+age out instead of being invalidated.
+"""
+import errno
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from .cumulus_settings import CUMULUS
+
+
+class DiskObjectCache(object):
+    """
+    Object bodies stored under ``directory``, evicted least recently used first once they take more than
+    ``max_bytes``.
+
+    Files are written to a temporary name and renamed into place, so any number of processes can share a
+    directory. They keep a running byte total under an exclusive lock, and the directory is only walked to evict
+    entries once that total is over budget. A reader holding an evicted file open keeps reading it.
+    Hits, misses and bytes saved are counted per process.
+    """
+    def __init__(self, directory, max_bytes, max_object_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes or max_bytes // 10
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory, 0700)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def _path(self, container_name, name, etag):
+        key = hashlib.sha1(u"\0".join((container_name, name, etag)).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def cacheable(self, size):
+        return size is not None and size <= self.max_object_bytes
+
+    def get(self, container_name, name, etag):
+        """
+        An open file of the cached body, or None on a miss. Hits count as recently used.
+        """
+        path = self._path(container_name, name, etag)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += os.fstat(f.fileno()).st_size
+        return f
+
+    def put(self, container_name, name, etag, chunks):
+        """
+        Writes the body from an iterator of ``chunks``, evicts entries over budget and returns the cached file,
+        opened before eviction could remove it.
+        """
+        path = self._path(container_name, name, etag)
+        try:
+            os.makedirs(os.path.dirname(path), 0700)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.rename(temp_path, path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+        f = open(path, "rb")
+        self._add(os.fstat(f.fileno()).st_size)
+        return f
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.directory, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_total(self):
+        try:
+            with open(os.path.join(self.directory, ".size")) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def _write_total(self, total):
+        with open(os.path.join(self.directory, ".size"), "w") as f:
+            f.write(str(total))
+
+    def _add(self, size):
+        """
+        Adds ``size`` bytes to the total shared by every process in the ``.size`` file, and only walks the cache
+        when there is no total yet or it is over budget.
+        """
+        with self._locked():
+            total = self._read_total()
+            if total is None or total + size > self.max_bytes:
+                # The walk finds the file just written, so its size isn't added again
+                total = self._evict()
+            else:
+                total += size
+            self._write_total(total)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in ``max_bytes``.
+        """
+        with self._locked():
+            self._write_total(self._evict())
+
+    def _evict(self):
+        """
+        Walks the cache, evicting entries over budget, and returns the bytes left. Run under the lock.
+        """
+        entries, total = [], 0
+        for subdirectory in os.listdir(self.directory):
+            subdirectory = os.path.join(self.directory, subdirectory)
+            if not os.path.isdir(subdirectory):
+                continue
+            for filename in os.listdir(subdirectory):
+                if filename.startswith(".tmp"):
+                    continue
+                path = os.path.join(subdirectory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+        return total
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": self.hit_ratio,
+                "bytes_saved": self.bytes_saved}
+
+
+_disk_cache = None
+
+
+def get_disk_cache():
+    """
+    The shared DiskObjectCache, or None when CUMULUS["DISK_CACHE_DIR"] is not set.
+    """
+    global _disk_cache
+    if not CUMULUS["DISK_CACHE_DIR"]:
+        return None
+    if _disk_cache is None:
+        _disk_cache = DiskObjectCache(CUMULUS["DISK_CACHE_DIR"], CUMULUS["DISK_CACHE_MAX_BYTES"],
+                                      CUMULUS["DISK_CACHE_MAX_OBJECT_BYTES"])
+    return _disk_cache
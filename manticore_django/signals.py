@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+
+# Sent by resize_model_photos with `instance` and `reason` when a save doesn't need new derivatives
+derivatives_skipped = Signal()
+
+# Sent once derivatives were generated, with `instance` and the `sizes` that were processed
+derivatives_generated = Signal()
@@ -1,15 +1,28 @@
 from random import choice
 
+import hashlib
+import json
 import mimetypes
 import pyrax
 import re
+import socket
 import swiftclient
+import threading
+import time
+import zlib
+from datetime import datetime
+from email.utils import mktime_tz, parsedate_tz
 from gzip import GzipFile
 from StringIO import StringIO
+from urllib import quote
 from django.core.files.base import File, ContentFile
 from django.core.files.storage import Storage
 
+from .container_health import container_health, get_container_selector
 from .cumulus_settings import CUMULUS
+from .object_cache import get_disk_cache
+from .token_cache import authenticate_pyrax, get_token_store, swiftclient_preauth
+from .utils import get_thread_pool
 
 
 ######### FROM DJANGO-CUMULUS UNRELEASED v1.1 #########
@@ -40,15 +53,238 @@ def sync_headers(cloud_obj, headers={}, header_patterns=HEADER_PATTERNS):
         cloud_obj.sync_metadata()
 
 
-def get_gzipped_contents(input_file):
+class GzipStream(object):
+    """
+    Read-only file-like gzip of another file, compressed chunk by chunk as it is read, so an upload never
+    holds more than a chunk of either the original or the compressed data.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, fileobj, level=6):
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.buffer = ""
+        self.finished = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            chunk = self.fileobj.read(self.chunk_size)
+            if chunk:
+                self.bytes_in += len(chunk)
+                self.buffer += self.compressor.compress(chunk)
+            else:
+                self.buffer += self.compressor.flush()
+                self.finished = True
+        if size < 0:
+            data, self.buffer = self.buffer, ""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.bytes_out += len(data)
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), "")
+
+
+def get_gzip_level(content_type):
+    """
+    Compression level for ``content_type`` from CUMULUS["GZIP_CONTENT_TYPES"], or None if it isn't gzipped.
+
+    GZIP_CONTENT_TYPES is either a list of content types compressed at level 6 or a dict of content type to level.
+    """
+    content_types = CUMULUS.get("GZIP_CONTENT_TYPES") or []
+    if isinstance(content_types, dict):
+        return content_types.get(content_type)
+    return 6 if content_type in content_types else None
+
+
+def worth_gzipping(content, level):
+    """
+    Compresses the first CUMULUS["GZIP_SAMPLE_SIZE"] bytes of ``content`` and checks they shrink to at most
+    CUMULUS["GZIP_MAX_RATIO"] of their size. Files smaller than CUMULUS["GZIP_MIN_SIZE"] are never worth it.
+    """
+    size = getattr(content, "size", None)
+    if size is not None and size < CUMULUS["GZIP_MIN_SIZE"]:
+        return False
+    content.seek(0)
+    sample = content.read(CUMULUS["GZIP_SAMPLE_SIZE"])
+    content.seek(0)
+    if len(sample) < CUMULUS["GZIP_MIN_SIZE"]:
+        return False
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compressed = len(compressor.compress(sample)) + len(compressor.flush())
+    return compressed <= len(sample) * CUMULUS["GZIP_MAX_RATIO"]
+
+
+def get_gzipped_contents(input_file, level=6):
     """
     Returns a gzipped version of a previously opened file's buffer.
     """
-    zbuf = StringIO()
-    zfile = GzipFile(mode="wb", compresslevel=6, fileobj=zbuf)
-    zfile.write(input_file.read())
-    zfile.close()
-    return ContentFile(zbuf.getvalue())
+    return ContentFile(GzipStream(input_file, level).read())
+
+
+def parse_last_modified(value):
+    """
+    Parses a Last-Modified header or a listing's last_modified value into a naive local datetime.
+    """
+    if not value:
+        return None
+    parsed = parsedate_tz(value)
+    if parsed:
+        return datetime.fromtimestamp(mktime_tz(parsed))
+    utc = datetime.strptime(value.split(".")[0], "%Y-%m-%dT%H:%M:%S")
+    return utc + (datetime.fromtimestamp(0) - datetime.utcfromtimestamp(0))
+
+
+class ObjectMetaCache(object):
+    """
+    Per-process TTL cache of object metadata keyed by (container, name).
+
+    Missing objects are cached too, as None, for a shorter time.
+    """
+    def __init__(self, ttl, negative_ttl, max_entries):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, container_name, name):
+        """
+        Returns ``(found, meta)``; ``found`` is False when nothing (or only an expired entry) is cached.
+        """
+        with self._lock:
+            entry = self._entries.get((container_name, name))
+            if entry is None:
+                return False, None
+            expires, meta = entry
+            if expires < time.time():
+                del self._entries[(container_name, name)]
+                return False, None
+            return True, meta
+
+    def set(self, container_name, name, meta):
+        ttl = self.ttl if meta is not None else self.negative_ttl
+        if not ttl:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                now = time.time()
+                for key in [key for key, (expires, value) in self._entries.items() if expires < now]:
+                    del self._entries[key]
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[(container_name, name)] = (time.time() + ttl, meta)
+
+    def invalidate(self, container_name, name):
+        with self._lock:
+            self._entries.pop((container_name, name), None)
+
+
+object_meta_cache = ObjectMetaCache(CUMULUS["OBJECT_CACHE_TTL"], CUMULUS["OBJECT_CACHE_NEGATIVE_TTL"],
+                                    CUMULUS["OBJECT_CACHE_MAX_ENTRIES"])
+
+
+class ContainerURLCache(object):
+    """
+    Per-process cache of each container's ``(cdn_uri, cdn_ssl_uri)``.
+
+    URIs are fetched once per container and kept for ``refresh`` seconds. After that the stale URIs are still
+    served while one background thread fetches them again, so building URLs only waits on the API the first
+    time a container is seen.
+    """
+    def __init__(self, refresh):
+        self.refresh = refresh
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, container_name, fetch):
+        with self._lock:
+            entry = self._entries.get(container_name)
+            stale = (entry is not None and entry[0] < time.time() and container_name not in self._refreshing)
+            if stale:
+                self._refreshing.add(container_name)
+        if entry is None:
+            uris = fetch()
+            self.set(container_name, uris)
+            return uris
+        if stale:
+            thread = threading.Thread(target=self._refresh, args=(container_name, fetch))
+            thread.daemon = True
+            thread.start()
+        return entry[1]
+
+    def set(self, container_name, uris):
+        with self._lock:
+            self._entries[container_name] = (time.time() + self.refresh, uris)
+
+    def _refresh(self, container_name, fetch):
+        try:
+            self.set(container_name, fetch())
+        except Exception:
+            # Keep serving the stale URIs, the next url() retries
+            pass
+        finally:
+            with self._lock:
+                self._refreshing.discard(container_name)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+container_url_cache = ContainerURLCache(CUMULUS["CONTAINER_URL_REFRESH"])
+
+
+class ConnectionPool(object):
+    """
+    Cloud Files connections, created lazily on first use and kept per thread.
+
+    Each thread checks out its own connection for a key such as (region, public), so threads never share
+    one client, and each connection keeps its HTTP connection alive between requests of that thread.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self, key, factory):
+        connections = self._local.__dict__.setdefault("connections", {})
+        if key not in connections:
+            connections[key] = factory()
+        return connections[key]
+
+    def clear(self):
+        """
+        Drops this thread's connections.
+        """
+        self._local.__dict__.pop("connections", None)
+
+
+connection_pool = ConnectionPool()
+
+# Containers this process has already created or confirmed
+created_containers = set()
+
+
+def connect_swiftclient():
+    """
+    Creates a swiftclient connection, pre-authenticated from the shared token store when one is configured.
+    """
+    kwargs = {
+        "authurl": CUMULUS["AUTH_URL"],
+        "user": CUMULUS["USERNAME"],
+        "key": CUMULUS["API_KEY"],
+        "snet": CUMULUS["SERVICENET"],
+        "auth_version": CUMULUS["AUTH_VERSION"],
+        "tenant_name": CUMULUS["AUTH_TENANT_NAME"],
+    }
+    if get_token_store():
+        url, token = swiftclient_preauth(CUMULUS["AUTH_URL"], CUMULUS["USERNAME"],
+                                         lambda: swiftclient.Connection(**kwargs).get_auth())
+        kwargs.update(preauthurl=url, preauthtoken=token)
+    return swiftclient.Connection(**kwargs)
 
 
 class SwiftclientStorage(Storage):
@@ -82,9 +318,7 @@ class SwiftclientStorage(Storage):
             self.connection_kwargs = connection_kwargs
         # connect
         if CUMULUS["USE_PYRAX"]:
-            if CUMULUS["PYRAX_IDENTITY_TYPE"]:
-                pyrax.set_setting("identity_type", CUMULUS["PYRAX_IDENTITY_TYPE"])
-            pyrax.set_credentials(self.username, self.api_key)
+            authenticate_pyrax(self.username, self.api_key)
 
     def __getstate__(self):
         """
@@ -98,44 +332,102 @@ class SwiftclientStorage(Storage):
             "connection_kwargs": self.connection_kwargs
         }
 
+    def _get_local(self):
+        """
+        Per-thread state of this storage: its container and, for multi-region use, its region.
+        """
+        local = self.__dict__.get("_local")
+        if local is None:
+            local = self.__dict__.setdefault("_local", threading.local())
+        return local
+
+    _local = property(_get_local)
+
+    def _get_region(self):
+        return getattr(self._local, "region", None) or self.region
+
+    def _get_region_connection(self, region):
+        """
+        This thread's pyrax connection to ``region``, connecting on first use.
+        """
+        public = not self.use_snet  # invert
+
+        def connect():
+            # Unpickled storages skip __init__, so make sure this process has an identity
+            authenticate_pyrax(self.username, self.api_key)
+            return pyrax.connect_to_cloudfiles(region=region, public=public)
+
+        return connection_pool.get(("pyrax", region, public), connect)
+
+    ord_connection = property(lambda self: self._get_region_connection("ORD"))
+    dfw_connection = property(lambda self: self._get_region_connection("DFW"))
+
     def _get_connection(self):
-        if not hasattr(self, "_connection"):
-            if CUMULUS["USE_PYRAX"]:
-                public = not self.use_snet  # invert
-                self.ord_connection = pyrax.connect_to_cloudfiles(region="ORD",
-                                                               public=public)
-                self.dfw_connection = pyrax.connect_to_cloudfiles(region="DFW",
-                                                               public=public)
-                if CUMULUS["REGION"] == "ORD":
-                    self._connection = self.ord_connection
-                else:
-                    self._connection = self.dfw_connection
-            else:
-                self._connection = swiftclient.Connection(
-                    authurl=CUMULUS["AUTH_URL"],
-                    user=CUMULUS["USERNAME"],
-                    key=CUMULUS["API_KEY"],
-                    snet=CUMULUS["SERVICENET"],
-                    auth_version=CUMULUS["AUTH_VERSION"],
-                    tenant_name=CUMULUS["AUTH_TENANT_NAME"],
-                )
-        return self._connection
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            return connection
+        if CUMULUS["USE_PYRAX"]:
+            return self._get_region_connection(self._get_region())
+        return connection_pool.get(
+            ("swiftclient", CUMULUS["AUTH_URL"], CUMULUS["USERNAME"], CUMULUS["SERVICENET"]),
+            connect_swiftclient)
 
     def _set_connection(self, value):
-        self._connection = value
+        self._local.connection = value
 
     connection = property(_get_connection, _set_connection)
 
+    def _get_container_connection(self, container_name):
+        """
+        This thread's connection to the region of ``container_name``, unless a connection was set on the storage.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            return connection
+        if CUMULUS["USE_PYRAX"]:
+            return self._get_region_connection(self._get_container_region(container_name))
+        return connection_pool.get(
+            ("swiftclient", CUMULUS["AUTH_URL"], CUMULUS["USERNAME"], CUMULUS["SERVICENET"]),
+            connect_swiftclient)
+
+    def _resolve(self, name):
+        """
+        ``(connection, container name, object name)`` for a stored name.
+
+        Worked out on every call and passed along explicitly, so concurrent operations never depend on a
+        container or connection another thread may have switched.
+        """
+        return self._get_container_connection(self.container_name), self.container_name, name
+
+    def _swift(self, connection):
+        """
+        The swiftclient Connection behind ``connection``, for the requests pyrax's cf_wrapper doesn't expose
+        (ranged reads, streamed uploads, raw headers and listings with subdirectories).
+        """
+        return connection.connection if CUMULUS["USE_PYRAX"] else connection
+
+    def _ensure_container(self, connection, container_name):
+        """
+        Creates the container the first time this process writes to it.
+        """
+        if container_name in created_containers:
+            return
+        if CUMULUS["USE_PYRAX"]:
+            connection.create_container(container_name)
+        else:
+            connection.put_container(container_name)
+        created_containers.add(container_name)
+
     def _get_container(self):
         """
         Gets or creates the container.
         """
-        if not hasattr(self, "_container"):
+        if not hasattr(self._local, "container"):
             if CUMULUS["USE_PYRAX"]:
-                self._container = self.connection.create_container(self.container_name)
+                self._local.container = self.connection.create_container(self.container_name)
             else:
-                self._container = None
-        return self._container
+                self._local.container = None
+        return self._local.container
 
     def _set_container(self, container):
         """
@@ -145,80 +437,278 @@ class SwiftclientStorage(Storage):
         if CUMULUS["USE_PYRAX"]:
             if container.cdn_ttl != self.ttl or not container.cdn_enabled:
                 container.make_public(ttl=self.ttl)
-            if hasattr(self, "_container_public_uri"):
-                delattr(self, "_container_public_uri")
-        self._container = container
+        self._local.container = container
 
     container = property(_get_container, _set_container)
 
-    def _get_container_url(self):
+    def _get_container_region(self, container_name):
+        return self.region
+
+    def _fetch_cdn_uris(self, container_name):
+        """
+        Looks up ``(cdn_uri, cdn_ssl_uri)`` of a container from the API, or from CUMULUS["CONTAINER_CDN_URIS"].
+        """
+        if container_name in CUMULUS["CONTAINER_CDN_URIS"]:
+            return tuple(CUMULUS["CONTAINER_CDN_URIS"][container_name])
+        connection = self._get_container_connection(container_name)
+        if CUMULUS["USE_PYRAX"]:
+            container = connection.get_container(container_name)
+            return container.cdn_uri, container.cdn_ssl_uri
+        # Plain Swift has no CDN, objects are served from the storage URL
+        url = "%s/%s" % (connection.get_auth()[0], quote(container_name))
+        return url, url
+
+    def _get_container_url(self, container_name=None):
+        """
+        Public base URL of ``container_name``, by default this thread's container, without touching the API
+        once its CDN URIs are cached.
+        """
         if self.use_ssl and CUMULUS["CONTAINER_SSL_URI"]:
-            self._container_public_uri = CUMULUS["CONTAINER_SSL_URI"]
-        elif self.use_ssl:
-            self._container_public_uri = self.container.cdn_ssl_uri
-        elif CUMULUS["CONTAINER_URI"]:
-            self._container_public_uri = CUMULUS["CONTAINER_URI"]
+            uri = CUMULUS["CONTAINER_SSL_URI"]
+        elif not self.use_ssl and CUMULUS["CONTAINER_URI"]:
+            uri = CUMULUS["CONTAINER_URI"]
         else:
-            self._container_public_uri = self.container.cdn_uri
-        if CUMULUS["CNAMES"] and self._container_public_uri in CUMULUS["CNAMES"]:
-            self._container_public_uri = CUMULUS["CNAMES"][self._container_public_uri]
-        return self._container_public_uri
+            if container_name is None:
+                container_name = getattr(getattr(self._local, "container", None), "name", None) or self.container_name
+            cdn_uri, cdn_ssl_uri = container_url_cache.get(container_name,
+                                                           lambda: self._fetch_cdn_uris(container_name))
+            uri = cdn_ssl_uri if self.use_ssl else cdn_uri
+        if CUMULUS["CNAMES"] and uri in CUMULUS["CNAMES"]:
+            uri = CUMULUS["CNAMES"][uri]
+        return uri
 
-    container_url = property(_get_container_url)
+    container_url = property(lambda self: self._get_container_url())
 
     def _get_object(self, name):
         """
-        Helper function to retrieve the requested Object.
+        Helper function to check the requested Object exists.
+
+        Looks the object up with a single HEAD request instead of listing the container.
         """
-        if name not in self.container.get_object_names():
-            return False
+        return bool(self._get_object_meta(name))
+
+    def _get_object_meta(self, name):
+        """
+        Returns the size, etag, last-modified, content type and headers of an object, or None if it doesn't exist.
+
+        Results (including misses) are served from the per-process object_meta_cache until they expire. The HEAD
+        goes through swiftclient on both transports: pyrax's wrapper would add a container lookup, and older
+        releases re-authenticate on every error, 404s included.
+        """
+        connection, container_name, object_name = self._resolve(name)
+        found, meta = object_meta_cache.get(container_name, object_name)
+        if found:
+            return meta
+        return self._head_object(self._swift(connection), container_name, object_name)
+
+    def _head_object(self, connection, container_name, name):
+        try:
+            headers = connection.head_object(container_name, name)
+        except swiftclient.ClientException as exc:
+            if exc.http_status != 404:
+                raise
+            meta = None
         else:
-            return self.container.get_object(name)
+            meta = {
+                "size": int(headers.get("content-length", 0)),
+                "etag": headers.get("etag"),
+                "last_modified": headers.get("last-modified"),
+                "content_type": headers.get("content-type"),
+                "headers": headers,
+            }
+        object_meta_cache.set(container_name, name, meta)
+        return meta
+
+    def _get_range(self, name, start, chunk_size):
+        """
+        Streams an object from byte ``start`` to its end with one open-ended Range request, returning
+        ``(response headers, iterator of chunk_size chunks)``.
+
+        pyrax's cf_wrapper can't stream a response, so its swiftclient Connection is used directly.
+        """
+        connection, container_name, name = self._resolve(name)
+        try:
+            headers, body = self._swift(connection).get_object(container_name, name, resp_chunk_size=chunk_size,
+                                                               headers={"Range": "bytes=%d-" % start})
+        except swiftclient.ClientException as exc:
+            if exc.http_status == 404:
+                raise IOError("No such object: %s" % name)
+            raise
+        return headers, self._iter_body(body)
+
+    def _iter_body(self, body):
+        try:
+            for chunk in body:
+                yield chunk
+        finally:
+            # Abandoning a response half read must not leave it on a pooled connection
+            close = getattr(getattr(body, "resp", None), "close", None)
+            if close:
+                close()
 
     def _open(self, name, mode="rb"):
         """
-        Returns the SwiftclientStorageFile.
+        Returns the SwiftclientStorageFile, or a File of the local copy when the disk cache is enabled.
         """
+        disk_cache = get_disk_cache()
+        if disk_cache is not None:
+            meta = self._get_object_meta(name)
+            if meta and meta["etag"] and disk_cache.cacheable(meta["size"]):
+                connection, container_name, object_name = self._resolve(name)
+                cached = disk_cache.get(container_name, object_name, meta["etag"])
+                if cached is None:
+                    remote = SwiftclientStorageFile(storage=self, name=name)
+                    chunks = remote.chunks(CUMULUS["READ_AHEAD_SIZE"])
+                    cached = disk_cache.put(container_name, object_name, meta["etag"], chunks)
+                return File(cached, name=name)
         return SwiftclientStorageFile(storage=self, name=name)
 
     def _save(self, name, content):
         """
         Uses the Swiftclient service to write ``content`` to a remote
-        file (called ``name``).
+        file (called ``name``), recording how the upload went in container_health.
+        """
+        connection, container_name, object_name = self._resolve(name)
+        region = self._get_container_region(container_name)
+        size = getattr(content, "size", None)
+        started = time.time()
+        try:
+            self._ensure_container(connection, container_name)
+            self._upload(connection, container_name, object_name, content)
+        except Exception:
+            container_health.record(container_name, region, time.time() - started, size, error=True)
+            raise
+        finally:
+            object_meta_cache.invalidate(container_name, object_name)
+        container_health.record(container_name, region, time.time() - started, size)
+        return name
+
+    def _upload(self, connection, container_name, object_name, content):
+        """
+        Writes ``content`` to an explicitly resolved container, segmented or gzipped when CUMULUS asks for it.
         """
         # Checks if the content_type is already set.
         # Otherwise uses the mimetypes library to guess.
         if hasattr(content.file, "content_type"):
             content_type = content.file.content_type
         else:
-            mime_type, encoding = mimetypes.guess_type(name)
+            mime_type, encoding = mimetypes.guess_type(object_name)
             content_type = mime_type
 
         headers = {"Content-Type": content_type}
 
-        # gzip the file if its of the right content type
-        if content_type in CUMULUS.get("GZIP_CONTENT_TYPES", []):
-            content_encoding = headers["Content-Encoding"] = "gzip"
-        else:
-            content_encoding = None
-
-        if CUMULUS["USE_PYRAX"]:
+        size = getattr(content, "size", None)
+        if CUMULUS["LARGE_OBJECT_THRESHOLD"] and size and size > CUMULUS["LARGE_OBJECT_THRESHOLD"]:
+            self._save_large_object(connection, container_name, object_name, content, size, headers)
+            return
+
+        # gzip the file if its of the right content type and compresses well enough
+        level = get_gzip_level(content_type)
+        if level is not None and worth_gzipping(content, level):
+            headers["Content-Encoding"] = "gzip"
+            # A gzip stream's size and checksum aren't known up front, so it goes up with chunked transfer
+            # encoding, which only swiftclient's put_object supports
+            self._swift(connection).put_object(container_name, object_name, GzipStream(content, level),
+                                               chunk_size=GzipStream.chunk_size, headers=headers)
+        elif CUMULUS["USE_PYRAX"]:
             # TODO set headers
-            if content_encoding == "gzip":
-                content = get_gzipped_contents(content)
-
-            self.connection.store_object(container=self.container.name,
-                                         obj_name=name,
-                                         data=content.read(),
-                                         content_type=content_type,
-                                         content_encoding=content_encoding,
-                                         etag=None)
+            connection.store_object(container=container_name,
+                                    obj_name=object_name,
+                                    data=content.read(),
+                                    content_type=content_type,
+                                    etag=None)
         else:
-            # TODO gzipped content when using swift client
-            self.connection.put_object(self.container.name, name,
-                                       content, headers=headers)
+            connection.put_object(container_name, object_name,
+                                  content, headers=headers)
 
-        return name
+    def _put_raw(self, connection, container_name, name, data, headers=None, query_string=None):
+        """
+        Uploads ``data`` as-is to any container, returning the etag Swift reports.
+        """
+        return self._swift(connection).put_object(container_name, name, data, headers=headers,
+                                                  query_string=query_string)
+
+    def _head_raw_etag(self, connection, container_name, name):
+        """
+        Etag of an object in any container, or None if it doesn't exist.
+        """
+        try:
+            return self._swift(connection).head_object(container_name, name).get("etag")
+        except swiftclient.ClientException as exc:
+            if exc.http_status == 404:
+                return None
+            raise
+
+    def _save_large_object(self, connection, container_name, name, content, size, headers):
+        """
+        Streams ``content`` into the segments container in CUMULUS["SEGMENT_SIZE"] pieces, uploaded
+        concurrently, then writes a Static or Dynamic (CUMULUS["LARGE_OBJECT_MANIFEST"]) Large Object manifest
+        under ``name``.
+
+        Segment names only depend on the object name and sizes, so a failed upload can be retried and segments
+        already stored with a matching etag are skipped. Segments waiting for or being uploaded take at most
+        CUMULUS["SEGMENT_BUFFER_BYTES"] of memory. The first segment that fails for good stops the upload.
+        """
+        segment_size = CUMULUS["SEGMENT_SIZE"]
+        segment_container = container_name + CUMULUS["SEGMENT_CONTAINER_SUFFIX"]
+        prefix = "%s/%d/%d/" % (name, size, segment_size)
+        static = CUMULUS["LARGE_OBJECT_MANIFEST"] == "static"
+
+        self._ensure_container(connection, segment_container)
+
+        slots = threading.BoundedSemaphore(max(1, CUMULUS["SEGMENT_BUFFER_BYTES"] // segment_size))
+        failed = threading.Event()
+
+        def upload_segment(index, data):
+            try:
+                if failed.is_set():
+                    return None
+                # Pool threads use their own pooled connection, to the same region as the object's container
+                segment_connection = self._get_container_connection(container_name)
+                segment_name = "%s%08d" % (prefix, index)
+                etag = hashlib.md5(data).hexdigest()
+                if self._head_raw_etag(segment_connection, segment_container, segment_name) != etag:
+                    for attempt in range(CUMULUS["SEGMENT_RETRIES"]):
+                        try:
+                            self._put_raw(segment_connection, segment_container, segment_name, data)
+                            break
+                        except (swiftclient.ClientException, socket.error):
+                            if attempt == CUMULUS["SEGMENT_RETRIES"] - 1:
+                                raise
+                return {"path": "/%s/%s" % (segment_container, segment_name), "etag": etag,
+                        "size_bytes": len(data)}
+            except Exception:
+                failed.set()
+                raise
+            finally:
+                slots.release()
+
+        # Segments have a pool of their own, as they are uploaded from within the shared "uploads" pool
+        pool = get_thread_pool("segments", CUMULUS["SEGMENT_THREADS"])
+        results = []
+        try:
+            content.seek(0)
+            index = 0
+            while True:
+                slots.acquire()
+                data = None if failed.is_set() else content.read(segment_size)
+                if not data:
+                    slots.release()
+                    break
+                results.append(pool.apply_async(upload_segment, (index, data)))
+                index += 1
+        finally:
+            for result in results:
+                result.wait()
+        segments = [result.get() for result in results]
+
+        manifest_headers = dict(headers)
+        if static:
+            self._put_raw(connection, container_name, name, json.dumps(segments), manifest_headers,
+                          query_string="multipart-manifest=put")
+        else:
+            manifest_headers["X-Object-Manifest"] = "%s/%s" % (segment_container, prefix)
+            self._put_raw(connection, container_name, name, "", manifest_headers)
 
     def delete(self, name):
         """
@@ -226,13 +716,16 @@ class SwiftclientStorage(Storage):
 
         Deleting a model doesn't delete associated files: bit.ly/12s6Oox
         """
+        connection, container_name, name = self._resolve(name)
         try:
-            self.connection.delete_object(self.container.name, name)
-        except pyrax.exceptions.ClientException as exc:
+            connection.delete_object(container_name, name)
+        except (pyrax.exceptions.ClientException, swiftclient.ClientException) as exc:
             if exc.http_status == 404:
                 pass
             else:
                 raise
+        finally:
+            object_meta_cache.invalidate(container_name, name)
 
     def exists(self, name):
         """
@@ -240,13 +733,19 @@ class SwiftclientStorage(Storage):
         exists in the storage system, or False if the name is
         available for a new file.
         """
-        return bool(self._get_object(name))
+        return self._get_object_meta(name) is not None
 
     def size(self, name):
         """
         Returns the total size, in bytes, of the file specified by name.
         """
-        return self._get_object(name).total_bytes
+        return self._get_object_meta(name)["size"]
+
+    def modified_time(self, name):
+        """
+        Returns the last modified time of the file specified by name as a naive local datetime.
+        """
+        return parse_last_modified(self._get_object_meta(name)["last_modified"])
 
     def url(self, name):
         """
@@ -255,22 +754,50 @@ class SwiftclientStorage(Storage):
         """
         return "{0}/{1}".format(self.container_url, name)
 
-    def listdir(self, path):
+    def iter_listdir(self, path, recursive=False, page_size=None):
         """
-        Lists the contents of the specified path, returning a 2-tuple;
-        the first being an empty list of directories (not available
-        for quick-listing), the second being a list of filenames.
+        Lazily yields ``(name, is_dir)`` for the contents of the specified path, names relative to the path.
 
-        If the list of directories is required, use the full_listdir method.
+        The listing is paged with Swift's prefix, delimiter and marker parameters, so only one page of at most
+        ``page_size`` (default CUMULUS["LISTING_PAGE_SIZE"]) entries is held at a time. Unless ``recursive``,
+        only the path's own level is listed, with subdirectories yielded once each.
         """
-        files = []
+        connection, container_name, path = self._resolve(path)
         if path and not path.endswith("/"):
             path = "{0}/".format(path)
         path_len = len(path)
-        for name in [x["name"] for x in
-                     self.connection.get_container(self.container_name, full_listing=True)[1]]:
-            files.append(name[path_len:])
-        return ([], files)
+        page_size = page_size or CUMULUS["LISTING_PAGE_SIZE"]
+        delimiter = None if recursive else "/"
+        marker = None
+        while True:
+            page = self._swift(connection).get_container(container_name, prefix=path or None,
+                                                         delimiter=delimiter, marker=marker, limit=page_size)[1]
+            if not page:
+                return
+            for entry in page:
+                if "subdir" in entry:
+                    marker = entry["subdir"]
+                    name = marker[path_len:].rstrip("/")
+                    if name:
+                        yield name, True
+                else:
+                    marker = entry["name"]
+                    name = marker[path_len:]
+                    if name and not name.endswith("/"):
+                        yield name, False
+            if len(page) < page_size:
+                return
+
+    def listdir(self, path):
+        """
+        Lists the contents of the specified path, returning a 2-tuple;
+        the first being a list of directories, the second being a list
+        of filenames, both for the path's own level only.
+        """
+        dirs, files = [], []
+        for name, is_dir in self.iter_listdir(path):
+            (dirs if is_dir else files).append(name)
+        return (dirs, files)
 
     def full_listdir(self, path):
         """
@@ -278,20 +805,7 @@ class SwiftclientStorage(Storage):
         of lists; the first item being directories, the second item
         being files.
         """
-        dirs = set()
-        files = []
-        if path and not path.endswith("/"):
-            path = "{0}/".format(path)
-        path_len = len(path)
-        for name in [x["name"] for x in
-                     self.connection.get_container(self.container_name, full_listing=True)[1]]:
-            name = name[path_len:]
-            slash = name[1:-1].find("/") + 1
-            if slash:
-                dirs.add(name[:slash])
-            elif name:
-                files.append(name)
-        dirs = list(dirs)
+        dirs, files = self.listdir(path)
         dirs.sort()
         return (dirs, files)
 
@@ -311,11 +825,22 @@ class SwiftclientStaticStorage(SwiftclientStorage):
 
 
 class SwiftclientStorageFile(File):
-    closed = False
+    """
+    Remote object read with HTTP Range requests from the current position.
 
+    Sequential reads share one streaming response, read CUMULUS["READ_AHEAD_SIZE"] bytes at a time into a
+    buffer. Seeking outside the buffer drops the response and the next read starts a new Range request.
+    Objects stored with a gzip Content-Encoding are decompressed whole on the first read.
+    """
     def __init__(self, storage, name, *args, **kwargs):
         self._storage = storage
+        self._closed = False
         self._pos = 0
+        self._stream = None
+        self._stream_pos = 0
+        self._buffer = ""
+        self._buffer_pos = 0
+        self._decoded = False
         super(SwiftclientStorageFile, self).__init__(file=None, name=name,
                                                      *args, **kwargs)
 
@@ -334,7 +859,11 @@ class SwiftclientStorageFile(File):
 
     def _get_file(self):
         if not hasattr(self, "_file"):
-            self._file = self._storage._get_object(self.name)
+            if CUMULUS["USE_PYRAX"]:
+                connection, container_name, name = self._storage._resolve(self.name)
+                self._file = connection.get_object(container_name, name)
+            else:
+                self._file = self._storage._get_object(self.name)
             self._file.tell = self._get_pos
         return self._file
 
@@ -349,24 +878,61 @@ class SwiftclientStorageFile(File):
 
     def read(self, chunk_size=-1):
         """
-        Reads specified chunk_size or the whole file if chunk_size is None.
-
-        If reading the whole file and the content-encoding is gzip, also
-        gunzip the read content.
+        Reads specified chunk_size or the whole rest of the file if chunk_size is None or negative.
+        """
+        if chunk_size is None:
+            chunk_size = -1
+        parts = []
+        wanted = chunk_size
+        while wanted != 0 and self._pos < self.size:
+            offset = self._pos - self._buffer_pos
+            if 0 <= offset < len(self._buffer):
+                data = self._buffer[offset:offset + wanted] if wanted > 0 else self._buffer[offset:]
+                parts.append(data)
+                self._pos += len(data)
+                wanted -= len(data) if wanted > 0 else 0
+            elif not self._fill():
+                break
+        return "".join(parts)
+
+    def _fill(self):
         """
-        if self._pos == self._get_size() or chunk_size == 0:
-            return ""
+        Reads the next read-ahead chunk from the current position into the buffer, opening a new Range request
+        unless the current one is already there. Returns False at the end of the object.
+        """
+        if self._decoded:
+            return False
+        if self._stream is None or self._stream_pos != self._pos:
+            self._close_stream()
+            headers, self._stream = self._storage._get_range(self.name, self._pos, CUMULUS["READ_AHEAD_SIZE"])
+            self._stream_pos = self._pos
+            if headers.get("content-encoding") == "gzip":
+                self._decode()
+                return True
+
+        data = next(self._stream, "")
+        if not data:
+            self._close_stream()
+            return False
+        self._buffer, self._buffer_pos = data, self._stream_pos
+        self._stream_pos += len(data)
+        return True
 
-        if chunk_size < 0:
-            meta, data = self.file.get(include_meta=True)
-            if meta.get('content-encoding', None) == 'gzip':
-                zbuf = StringIO(data)
-                zfile = GzipFile(mode="rb", fileobj=zbuf)
-                data = zfile.read()
-        else:
-            data = self.file.get(chunk_size=chunk_size).next()
-        self._pos += len(data)
-        return data
+    def _decode(self):
+        """
+        Downloads and gunzips the whole object into the buffer, which then stands in for the object.
+        """
+        self._close_stream()
+        headers, stream = self._storage._get_range(self.name, 0, CUMULUS["READ_AHEAD_SIZE"])
+        self._buffer = GzipFile(mode="rb", fileobj=StringIO("".join(stream))).read()
+        self._buffer_pos = 0
+        self._size = len(self._buffer)
+        self._decoded = True
+
+    def _close_stream(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
 
     def chunks(self, chunk_size=None):
         """
@@ -374,24 +940,37 @@ class SwiftclientStorageFile(File):
         """
         if not chunk_size:
             chunk_size = self.DEFAULT_CHUNK_SIZE
-        return self.file.get(chunk_size=chunk_size)
+        self.seek(0)
+        return iter(lambda: self.read(chunk_size), "")
 
     def open(self, *args, **kwargs):
         """
         Opens the cloud file object.
         """
         self._pos = 0
+        self._closed = False
 
     def close(self, *args, **kwargs):
+        self._close_stream()
         self._pos = 0
+        self._closed = True
 
     @property
     def closed(self):
-        return not hasattr(self, "_file")
-
-    def seek(self, pos):
+        return self._closed
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self.size
+        if pos < 0:
+            raise IOError("Invalid seek position %d" % pos)
         self._pos = pos
 
+    def tell(self):
+        return self._pos
+
 
 ######### END FROM DJANGO-CUMULUS UNRELEASED v1.1 #########
 
@@ -403,74 +982,71 @@ class MultiContainerCloudFilesStorage(SwiftclientStorage):
     active_containers = CUMULUS['ACTIVE_CONTAINERS']
     all_containers = CUMULUS['ALL_CONTAINERS']
 
-    def _open(self, name, mode='rb'):
-        name = self.set_current_container(name)
-        return super(MultiContainerCloudFilesStorage, self)._open(name, mode)
+    def get_available_name(self, name, *args, **kwargs):
+        """
+        Picks the container for a new file by prefixing it to 'name', so exists() and _save() work on the same
+        container without remembering it between calls.
+        """
+        name = self.choose_container(name)
+        return super(MultiContainerCloudFilesStorage, self).get_available_name(name, *args, **kwargs)
 
     def _save(self, name, content):
-        name = super(MultiContainerCloudFilesStorage, self)._save(name, content)
-        return "%s/%s" % (self.container.name, name)
-
-    def delete(self, name):
-        name = self.set_current_container(name)
-        return super(MultiContainerCloudFilesStorage, self).delete(name)
-
-    def exists(self, name):
-        self.set_random_container()
-        return super(MultiContainerCloudFilesStorage, self).exists(name)
+        return super(MultiContainerCloudFilesStorage, self)._save(self.choose_container(name), content)
 
     def url(self, name):
-        name = self.set_current_container(name)
-        return super(MultiContainerCloudFilesStorage, self).url(name)
-
-    def modified_time(self, name):
-        name = self.set_current_container(name)
-        return super(MultiContainerCloudFilesStorage, self).modified_time(name)
+        """
+        Builds the URL from cached container URIs, without selecting the container or touching the API.
+        """
+        container_name, name = self.split_name(name)
+        return "{0}/{1}".format(self._get_container_url(container_name), name)
 
-    def set_current_container(self, name):
+    def choose_container(self, name):
         """
-        Set the current container based on the first folder portion of 'name'
+        Prefixes 'name' with an active container picked by the CUMULUS["CONTAINER_SELECTION"] policy from recent
+        upload latency and errors, unless it already has a container.
         """
         container_name, separator, new_name = name.partition("/")
         if container_name in self.all_containers:
-            if self.container.name != container_name:
-                # Get region and set the connection
-                self.set_connection_by_container_name(container_name)
-
-                # Then get and set the container
-                self.container = self.connection.get_container(container_name)
-                if hasattr(self, '_container_public_uri'):
-                    delattr(self, '_container_public_uri')
-            return new_name
-        else:  # Else we need to use the default container
-            if self.container.name != self.container_name:
-                # Get region and set the connection
-                self.set_connection_by_container_name(self.container_name)
-
-                # Then get and set the container
-                self.container = self.connection.get_container(self.container_name)
-                if hasattr(self, '_container_public_uri'):
-                    delattr(self, '_container_public_uri')
             return name
+        return "%s/%s" % (get_container_selector().choose(self.active_containers), name)
+
+    def split_name(self, name):
+        """
+        Splits 'name' into its container, taken from the first folder portion, and the object name. Names
+        without a known container belong to the default container.
+        """
+        container_name, separator, new_name = name.partition("/")
+        if container_name in self.all_containers:
+            return container_name, new_name
+        return self.container_name, name
+
+    def _get_container_region(self, container_name):
+        return CUMULUS['CONTAINER_REGIONS'].get(container_name, self.region)
+
+    def _resolve(self, name):
+        container_name, name = self.split_name(name)
+        return self._get_container_connection(container_name), container_name, name
+
+    def set_current_container(self, name):
+        """
+        Set this thread's container and connection based on the first folder portion of 'name'.
+
+        Storage operations resolve their container per call and don't need this; it only changes what the
+        container and connection attributes return.
+        """
+        container_name, new_name = self.split_name(name)
+        if self.container.name != container_name:
+            self.set_connection_by_container_name(container_name)
+            self.container = self.connection.get_container(container_name)
+        return new_name
 
     def set_random_container(self):
         """
-        Set the container to a random container for load balancing
+        Set this thread's container to a random active container.
         """
         container_name = choice(self.active_containers)
-
-        # Get region and set the connection
         self.set_connection_by_container_name(container_name)
-
-        # Then get and set the container
         self.container = self.connection.get_container(container_name)
-        if hasattr(self, '_container_public_uri'):
-            delattr(self, '_container_public_uri')
 
     def set_connection_by_container_name(self, container_name):
-        self.connection
-
-        if CUMULUS['CONTAINER_REGIONS'][container_name] == "ORD":
-            self.connection = self.ord_connection
-        else:
-            self.connection = self.dfw_connection
\ No newline at end of file
+        self._local.region = CUMULUS['CONTAINER_REGIONS'][container_name]
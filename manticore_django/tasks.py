@@ -0,0 +1,16 @@
+from celery import shared_task
+
+from manticore_django.manticore_django.utils import get_model
+
+
+@shared_task(ignore_result=True)
+def generate_media_derivatives(app_label, model_name, pk, local_copy=None, original_name=None):
+    """
+    Generates the SIZES derivatives of a Media row that was saved with deferred thumbnails.
+
+    `local_copy` is the upload stashed by the web process, used instead of downloading the original when this
+    worker can see it.
+    """
+    from manticore_django.manticore_django.models import regenerate_media
+
+    regenerate_media(get_model(app_label, model_name), pk, local_copy, original_name)
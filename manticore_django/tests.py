@@ -1,6 +1,19 @@
+import os
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
+
 from django.test import TestCase
 from mezzanine.utils.tests import run_pyflakes_for_package, _run_checker_for_package
 import settings
+import swiftclient
+
+from manticore_django.manticore_django.benchmarks import InMemoryStorage
+from manticore_django.manticore_django.cumulus_settings import CUMULUS
+from manticore_django.manticore_django.management.commands import regenerate_derivatives
+from manticore_django.manticore_django.models import derivative_upload_name
+from manticore_django.manticore_django.storage import SwiftclientStorage
 
 
 class SyntaxTest(TestCase):
@@ -18,6 +31,130 @@ class SyntaxTest(TestCase):
             self.fail("{0} Syntax warnings!\n\n{1}".format(len(warnings), "\n".join(warnings)))
 
 
+class FailingSegmentConnection(object):
+    """
+    Swift connection that stores objects in memory and fails every upload of one segment
+    """
+    def __init__(self, failing_segment):
+        self.failing_segment = failing_segment
+        self.connection = self
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put_container(self, container_name):
+        pass
+
+    create_container = put_container
+
+    def head_object(self, container_name, name):
+        raise swiftclient.ClientException("Not found", http_status=404)
+
+    def put_object(self, container_name, name, data, headers=None, query_string=None):
+        if name.endswith("%08d" % self.failing_segment):
+            raise swiftclient.ClientException("Segment upload failed", http_status=503)
+        with self.lock:
+            self.objects[(container_name, name)] = data
+
+
+class LargeObjectTest(TestCase):
+    def setUp(self):
+        self.settings = dict(CUMULUS)
+        CUMULUS.update({"USE_PYRAX": False, "SEGMENT_SIZE": 10, "SEGMENT_THREADS": 2, "SEGMENT_RETRIES": 2,
+                        "SEGMENT_BUFFER_BYTES": 30})
+
+    def tearDown(self):
+        CUMULUS.clear()
+        CUMULUS.update(self.settings)
+
+    def test_failing_segment(self):
+        """
+        A segment that keeps failing stops the upload with its error, without deadlocking or writing a manifest.
+        """
+        connection = FailingSegmentConnection(failing_segment=2)
+        storage = SwiftclientStorage(container="test")
+        storage._get_container_connection = lambda container_name: connection
+        content = StringIO("x" * 200)
+
+        with self.assertRaises(swiftclient.ClientException):
+            storage._save_large_object(connection, "test", "large.bin", content, 200, {})
+        self.assertNotIn(("test", "large.bin"), connection.objects)
+
+
+class LazySizesInstance(object):
+    """
+    Just enough of a Media instance for naming derivatives: one LAZY_SIZES entry and a single file field storage
+    """
+    SIZES = {}
+    LAZY_SIZES = {"medium": {"width": 640, "height": 480}}
+
+    class _meta(object):
+        storage = InMemoryStorage()
+
+        @classmethod
+        def get_field(cls, name):
+            return cls
+
+
+class LazyDerivativeNameTest(TestCase):
+    def test_lazy_size_path(self):
+        """
+        Sizes only in LAZY_SIZES are stored under media/<size name>/, not at the storage root.
+        """
+        name = derivative_upload_name(LazySizesInstance(), "medium", "0123abcd.jpg")
+        self.assertEqual(name, "media/medium/0123abcd.jpg")
+
+
+class CheckpointedPhoto(object):
+    class _meta(object):
+        app_label = "app"
+        object_name = "Photo"
+
+
+class RecordingRegenerateCommand(regenerate_derivatives.Command):
+    """
+    regenerate_derivatives over one model with rows 2 and 5, recording the primary key each run resumes from
+    """
+    def __init__(self):
+        super(RecordingRegenerateCommand, self).__init__()
+        self.stdout, self.stderr = StringIO(), StringIO()
+        self.resumed_from = []
+
+    def get_media_models(self, labels):
+        return [CheckpointedPhoto]
+
+    def process_model(self, model, pool, last_pk, options):
+        self.resumed_from.append(last_pk)
+        for pk in (2, 5):
+            if last_pk is None or pk > last_pk:
+                yield pk
+
+
+class RegenerateCheckpointTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.directory, "checkpoint.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_finished_run_clears_checkpoint(self):
+        """
+        A run that finishes removes its checkpoint, so running the command again starts from the first row.
+        """
+        command = RecordingRegenerateCommand()
+        options = {"checkpoint": self.checkpoint, "processes": 1, "rate": 0, "batch_size": 500, "restart": False}
+        command.handle(**options)
+        command.handle(**options)
+        self.assertEqual(command.resumed_from, [None, None])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_interrupted_run_resumes(self):
+        command = RecordingRegenerateCommand()
+        command.write_checkpoint(self.checkpoint, {"app.Photo": 2})
+        command.handle(checkpoint=self.checkpoint, processes=1, rate=0, batch_size=500, restart=False)
+        self.assertEqual(command.resumed_from, [2])
+
+
 def run_pep8_for_package(package_name, extra_ignore=None):
     """
     Shamelessly copied from Mezzanine utils to modify the max line length
@@ -0,0 +1,250 @@
+"""
+Shares Cloud Files auth tokens and service catalogs between processes, so restarting many workers at once
+doesn't send each of them to the identity API.
+"""
+import calendar
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pyrax
+
+from .cumulus_settings import CUMULUS
+from .utils import get_cache, get_class
+
+
+class TokenStore(object):
+    """
+    Shared store for auth payloads. `get` returns ``(expires, payload)`` or None, and `lock` is held by one
+    process at a time while it refreshes a token.
+
+    Payloads are stored as JSON, so nothing read back from a store is ever unpickled into objects.
+    """
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, expires, payload):
+        raise NotImplementedError
+
+    def lock(self, key):
+        raise NotImplementedError
+
+
+class CacheTokenStore(TokenStore):
+    """
+    Keeps tokens in the Django cache named by CUMULUS["AUTH_TOKEN_CACHE"].
+    """
+    key_prefix = "cumulus-auth:"
+
+    def __init__(self):
+        self.cache = get_cache(CUMULUS["AUTH_TOKEN_CACHE"])
+
+    def get(self, key):
+        value = self.cache.get(self.key_prefix + key)
+        try:
+            return tuple(json.loads(value)) if value else None
+        except (TypeError, ValueError):
+            return None
+
+    def set(self, key, expires, payload):
+        self.cache.set(self.key_prefix + key, json.dumps([expires, payload]), max(1, int(expires - time.time())))
+
+    @contextmanager
+    def lock(self, key):
+        lock_key = self.key_prefix + key + ":lock"
+        timeout = CUMULUS["AUTH_TOKEN_LOCK_TIMEOUT"]
+        deadline = time.time() + timeout
+        acquired = self.cache.add(lock_key, 1, timeout)
+        while not acquired and time.time() < deadline and self.get(key) is None:
+            time.sleep(0.1)
+            acquired = self.cache.add(lock_key, 1, timeout)
+        try:
+            yield
+        finally:
+            if acquired:
+                self.cache.delete(lock_key)
+
+
+class FileTokenStore(TokenStore):
+    """
+    Keeps tokens in files under CUMULUS["AUTH_TOKEN_DIR"], by default a ``cumulus-auth-<uid>`` directory in the
+    system temporary directory.
+
+    The directory is created readable only by this user. An existing one owned by someone else, or open to other
+    users, is refused rather than trusted.
+    """
+    def __init__(self):
+        self.directory = (CUMULUS["AUTH_TOKEN_DIR"] or
+                          os.path.join(tempfile.gettempdir(), "cumulus-auth-%d" % os.getuid()))
+        try:
+            os.makedirs(self.directory, 0700)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        info = os.lstat(self.directory)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0077:
+            raise IOError("%s must be a directory owned by uid %d with no access for others" %
+                          (self.directory, os.getuid()))
+
+    def _path(self, key):
+        return os.path.join(self.directory, "%s.token" % key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return tuple(json.load(f))
+        except (IOError, TypeError, ValueError):
+            return None
+
+    def set(self, key, expires, payload):
+        # Write then rename so readers never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            json.dump([expires, payload], f)
+        os.rename(temp_path, self._path(key))
+
+    @contextmanager
+    def lock(self, key):
+        with os.fdopen(os.open(self._path(key) + ".lock", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+_store = None
+_local_lock = threading.RLock()
+
+
+def get_token_store():
+    """
+    The configured TokenStore, or None when CUMULUS["AUTH_TOKEN_STORE"] is not set.
+    """
+    global _store
+    if not CUMULUS["AUTH_TOKEN_STORE"]:
+        return None
+    if _store is None:
+        _store = get_class(CUMULUS["AUTH_TOKEN_STORE"])()
+    return _store
+
+
+def _token_key(*parts):
+    return hashlib.sha1(":".join(str(part) for part in parts)).hexdigest()
+
+
+def _expiry(expires):
+    """
+    Unix timestamp of a token expiry given as a datetime (UTC) or ISO 8601 string, or None.
+    """
+    if isinstance(expires, basestring):
+        try:
+            expires = datetime.strptime(expires[:19], "%Y-%m-%dT%H:%M:%S")
+        except ValueError:
+            return None
+    if isinstance(expires, datetime):
+        return calendar.timegm(expires.utctimetuple())
+    return None
+
+
+def _fresh(expires):
+    return expires is not None and expires - CUMULUS["AUTH_TOKEN_MARGIN"] > time.time()
+
+
+def _single_flight(key, load, refresh):
+    """
+    Applies a fresh payload from the store with ``load``, or runs ``refresh`` under the store's lock and shares
+    its ``(expires, payload)`` result. Only one process refreshes; the rest pick up what it stored.
+    """
+    store = get_token_store()
+    if store is None:
+        refresh()
+        return
+
+    cached = store.get(key)
+    if cached and _fresh(cached[0]) and load(cached[1]):
+        return
+    with store.lock(key):
+        cached = store.get(key)
+        if cached and _fresh(cached[0]) and load(cached[1]):
+            return
+        result = refresh()
+        if result:
+            store.set(key, *result)
+
+
+def authenticate_pyrax(username, api_key):
+    """
+    Makes sure pyrax has a valid identity for ``username`` in this process, reusing a shared cached one
+    when possible.
+    """
+    with _local_lock:
+        identity = getattr(pyrax, "identity", None)
+        if (getattr(identity, "authenticated", False) and getattr(identity, "username", None) == username and
+                _fresh(_expiry(getattr(identity, "expires", None)))):
+            return
+
+        if CUMULUS["PYRAX_IDENTITY_TYPE"]:
+            pyrax.set_setting("identity_type", CUMULUS["PYRAX_IDENTITY_TYPE"])
+
+        def load(payload):
+            # Credentials are set locally, only the token and service catalog come from the store
+            pyrax.set_credentials(username, api_key, authenticate=False)
+            identity = pyrax.identity
+            try:
+                identity.token = payload["token"]
+                identity.tenant_id = payload["tenant_id"]
+                identity.tenant_name = payload["tenant_name"]
+                identity.expires = datetime.utcfromtimestamp(payload["expires"])
+                identity.services = payload["services"]
+                identity.regions = set(payload["regions"])
+            except (KeyError, TypeError, ValueError):
+                return False
+            pyrax.regions = tuple(identity.regions)
+            pyrax.services = tuple(identity.services.keys())
+            identity.authenticated = True
+            return True
+
+        def refresh():
+            pyrax.set_credentials(username, api_key)
+            identity = pyrax.identity
+            expires = _expiry(getattr(identity, "expires", None)) or time.time() + CUMULUS["AUTH_TOKEN_TTL"]
+            return expires, {
+                "token": identity.token,
+                "tenant_id": getattr(identity, "tenant_id", None),
+                "tenant_name": getattr(identity, "tenant_name", None),
+                "expires": expires,
+                "services": identity.services,
+                "regions": sorted(identity.regions),
+            }
+
+        _single_flight(_token_key("pyrax", CUMULUS["PYRAX_IDENTITY_TYPE"], username), load, refresh)
+
+
+def swiftclient_preauth(authurl, user, get_auth):
+    """
+    ``(storage url, token)`` for a swiftclient connection, shared between processes through the token store.
+
+    ``get_auth`` authenticates and returns ``(storage url, token)`` when nothing fresh is cached.
+    """
+    result = {}
+
+    def load(payload):
+        result["auth"] = tuple(payload)
+        return True
+
+    def refresh():
+        result["auth"] = get_auth()
+        return time.time() + CUMULUS["AUTH_TOKEN_TTL"], result["auth"]
+
+    with _local_lock:
+        _single_flight(_token_key("swiftclient", authurl, user), load, refresh)
+    return result["auth"]
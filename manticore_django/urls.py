@@ -0,0 +1,9 @@
+from django.conf.urls import url
+
+from manticore_django.manticore_django.views import media_derivative
+
+
+urlpatterns = [
+    url(r'^(?P<app_label>\w+)/(?P<model_name>\w+)/(?P<pk>\d+)/(?P<size_name>\w+)/$', media_derivative,
+        name="media_derivative"),
+]
@@ -1,6 +1,9 @@
 from _ssl import SSLError
+from multiprocessing.pool import ThreadPool
 from swiftclient import ClientException
 import importlib
+import os
+import threading
 
 
 def retry_cloudfiles(method, *args):
@@ -27,4 +30,51 @@ def get_class(path):
     class_name = path_split[-1]
     module = importlib.import_module(module_path)
     _class = getattr(module, class_name)
-    return _class
\ No newline at end of file
+    return _class
+
+
+def get_model(app_label, model_name):
+    try:
+        from django.apps import apps
+        return apps.get_model(app_label, model_name)
+    except ImportError:
+        from django.db.models import get_model as _get_model
+        return _get_model(app_label, model_name)
+
+
+def get_models():
+    try:
+        from django.apps import apps
+        return apps.get_models()
+    except ImportError:
+        from django.db.models import get_models as _get_models
+        return _get_models()
+
+
+def get_cache(alias):
+    try:
+        from django.core.cache import caches
+        return caches[alias]
+    except ImportError:
+        from django.core.cache import get_cache as _get_cache
+        return _get_cache(alias)
+
+
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+
+def get_thread_pool(name, size):
+    """
+    The ThreadPool of ``size`` threads every caller in this process shares under ``name``.
+
+    Its threads live as long as the process, so the Cloud Files connection each of them keeps is authenticated
+    once and reused by later calls. Callers wait for their own results instead of closing the pool. A forked child
+    starts pools of its own.
+    """
+    with _thread_pools_lock:
+        pid, pool = _thread_pools.get(name, (None, None))
+        if pid != os.getpid():
+            pool = ThreadPool(max(1, size))
+            _thread_pools[name] = (os.getpid(), pool)
+        return pool
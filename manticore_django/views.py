@@ -0,0 +1,69 @@
+import time
+
+from django.http import Http404, HttpResponse
+from django.shortcuts import get_object_or_404, redirect
+
+from manticore_django.manticore_django.media_settings import MEDIA_PIPELINE
+from manticore_django.manticore_django.models import (Media, derivative_storage, get_size_spec,
+                                                      lazy_derivative_name, render_lazy_derivative)
+from manticore_django.manticore_django.utils import get_cache, get_model
+
+
+def lazy_render_allowed(model, size_name):
+    """
+    Whether MEDIA_PIPELINE["LAZY_RENDER_MODELS"] lets the view render `size_name` derivatives of `model`
+    """
+    allowed = dict((label.lower(), sizes) for label, sizes in MEDIA_PIPELINE["LAZY_RENDER_MODELS"].iteritems())
+    return size_name in allowed.get(("%s.%s" % (model._meta.app_label, model._meta.object_name)).lower(), ())
+
+
+def lazy_render_throttled(request):
+    """
+    Counts a render for the requesting client and returns True once it is over MEDIA_PIPELINE["LAZY_RENDER_RATE"],
+    a ``(renders, seconds)`` pair
+    """
+    rate = MEDIA_PIPELINE["LAZY_RENDER_RATE"]
+    if not rate:
+        return False
+    renders, seconds = rate
+    cache = get_cache(MEDIA_PIPELINE["LAZY_RENDER_CACHE"])
+    key = "lazy-render-rate:%s:%d" % (request.META.get("REMOTE_ADDR", ""), int(time.time() // seconds))
+    cache.add(key, 0, seconds)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # Expired between add and incr, so this is the first render of a new window
+        cache.set(key, 1, seconds)
+        count = 1
+    return count > renders
+
+
+def media_derivative(request, app_label, model_name, pk, size_name):
+    """
+    Redirects to the `size_name` derivative of a Media row, rendering it on the first request.
+
+    Only models and sizes listed in MEDIA_PIPELINE["LAZY_RENDER_MODELS"] are served, and each client may start
+    at most MEDIA_PIPELINE["LAZY_RENDER_RATE"] renders.
+    """
+    try:
+        model = get_model(app_label, model_name)
+    except LookupError:
+        raise Http404
+    if model is None or not issubclass(model, Media) or not lazy_render_allowed(model, size_name):
+        raise Http404
+    instance = get_object_or_404(model, pk=pk)
+
+    if get_size_spec(instance, size_name) is None:
+        raise Http404
+    original_file = getattr(instance, getattr(instance, "original_file_name", "original_file"))
+    if not original_file or instance.media_type == instance.TYPE_CHOICES.video:
+        raise Http404
+
+    stored_name = lazy_derivative_name(instance, size_name)
+    if not stored_name:
+        if lazy_render_throttled(request):
+            return HttpResponse("Too many derivatives requested, try again later", status=429)
+        stored_name = render_lazy_derivative(instance, size_name)
+    if not stored_name:
+        raise Http404
+    return redirect(derivative_storage(instance, size_name).url(stored_name))